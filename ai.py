@@ -3,119 +3,294 @@
 # last update: 2025/04/14
 
 
+import json
+import threading
 import openai
 import groq
+import httpx
 import requests
+from requests.adapters import HTTPAdapter
+from store import ChatHistories
+from history import estimate_tokens
+from metrics import registry
+from cache import ResponseCache
+from providers import Provider, CircuitOpen, HedgedCompleter, register, get_provider, get_providers
 from bot import bot
 
 openai_api_key = bot.settings["openai_api_key"]
-deepseek_api_key = bot.settings["deepseek_api_key"]
+deepseek_api_key = bot.settings.get("deepseek_api_key", "")
 groq_api_key = bot.settings["groq_api_key"]
 
-chatgpt_user_messages = {}
+# Every AI worker thread may hold one connection to each provider at a time.
+pool_size = int(bot.settings.get("ai_workers", 8))
+# The defaults for every provider, each of them can be changed for one provider too, like "groq_read_timeout": 20.
+connect_timeout = float(bot.settings.get("ai_connect_timeout", 5))
+read_timeout = float(bot.settings.get("ai_read_timeout", 60))
+retries = int(bot.settings.get("ai_retries", 2))
 
-def ask_chatgpt(user_id, question, api_key=openai_api_key, max_tokens=200, model="gpt-4"):
-    try:
-        if user_id not in chatgpt_user_messages:
-            chatgpt_user_messages[user_id] = []
+DEEPSEEK_URL = "https://api.deepseek.com/v1"
+
+# Each chat keeps as many of its latest messages as fit in this many tokens, plus the pinned system prompt if there is one.
+history_tokens = int(bot.settings.get("history_tokens", 3000))
+system_prompt = bot.settings.get("system_prompt", "")
 
-        chatgpt_user_messages[user_id].append({"role": "user", "content": question})
+# One long lived client per provider and api key, so the connections (and their TLS sessions) are reused between questions.
+_clients = {}
+_clients_lock = threading.Lock()
 
-        if len(chatgpt_user_messages[user_id]) > 30:
-            chatgpt_user_messages[user_id].pop(0)
 
-        client = openai.OpenAI(api_key=api_key)
-        response = client.chat.completions.create(
+def _create_client(provider):
+    if provider.name == "deepseek":
+        session = requests.Session()
+        session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+        session.headers.update({
+            "Authorization": f"Bearer {provider.api_key}",
+            "Content-Type": "application/json"
+        })
+        return session
+    http_client = httpx.Client(
+        limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+        timeout=httpx.Timeout(provider.read_timeout, connect=provider.connect_timeout)
+    )
+    # The SDKs would retry on their own, but Provider.request already does, with the circuit breaker in the loop.
+    if provider.name == "chatgpt":
+        return openai.OpenAI(api_key=provider.api_key, http_client=http_client, max_retries=0)
+    if provider.name == "groq":
+        return groq.Groq(api_key=provider.api_key, http_client=http_client, max_retries=0)
+    raise ValueError(f"Unknown provider: {provider.name}")
+
+
+def get_client(provider):
+    key = (provider.name, provider.api_key)
+    client = _clients.get(key)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(key)
+            if client is None:
+                client = _clients[key] = _create_client(provider)
+    return client
+
+
+def _stream_answer(stream, on_text):
+    # Pass every piece of a streamed OpenAI compatible completion to on_text as it arrives, and return the whole answer.
+    # The stream is closed when on_text raises, or from another thread by Abort, when another provider answered first.
+    parts = []
+    try:
+        for event in stream:
+            if not event.choices:
+                continue
+            text = event.choices[0].delta.content
+            if text:
+                parts.append(text)
+                on_text(text)
+    finally:
+        stream.close()
+    return "".join(parts)
+
+
+def _stream_sse_answer(response, on_text):
+    # Same as _stream_answer, for a raw server-sent events response from requests.
+    parts = []
+    response.encoding = "utf-8"
+    try:
+        for line in response.iter_lines(decode_unicode=True):
+            if not line or not line.startswith("data:"):
+                continue
+            data = line[len("data:"):].strip()
+            if data == "[DONE]":
+                break
+            choices = json.loads(data).get("choices")
+            text = choices[0].get("delta", {}).get("content") if choices else None
+            if text:
+                parts.append(text)
+                on_text(text)
+    finally:
+        response.close()
+    return "".join(parts)
+
+
+class OpenAICompatibleProvider(Provider):
+    # ChatGPT and Groq have the same API, and their SDKs the same interface.
+    sdk = None
+
+    def probe(self):
+        get_client(self).models.list()
+
+    def is_retryable(self, error):
+        if isinstance(error, self.sdk.APIStatusError):
+            return error.status_code == 429 or error.status_code >= 500
+        # httpx errors come through unwrapped when a stream breaks
+        return isinstance(error, (self.sdk.APIConnectionError, httpx.TransportError)) or super().is_retryable(error)
+
+    def complete(self, messages, model, max_tokens, on_text=None, abort=None):
+        response = get_client(self).chat.completions.create(
             model=model,
-            messages=chatgpt_user_messages[user_id],
-            max_tokens=max_tokens
+            messages=messages,
+            max_tokens=max_tokens,
+            stream=bool(on_text)
         )
+        if on_text:
+            if abort:
+                abort.register(response)
+            return _stream_answer(response, on_text)
+        return response.choices[0].message.content if response.choices else ""
 
-        if not response.choices:
-            return "مشکلی در دریافت پاسخ از ChatGPT به وجود آمد!"
 
-        answer = response.choices[0].message.content
-        chatgpt_user_messages[user_id].append({"role": "assistant", "content": answer})
+class ChatGPT(OpenAICompatibleProvider):
+    name, title, model = "chatgpt", "ChatGPT", "gpt-4o-mini"
+    sdk = openai
 
-        return answer.strip()
+    def error_message(self, error):
+        if isinstance(error, openai.OpenAIError):
+            return f"خطای OpenAI: {str(error)}"
+        if isinstance(error, ConnectionError):
+            return "اینترنت شما قطع است!"
+        return super().error_message(error)
 
-    except openai.OpenAIError as e:
-        return f"خطای OpenAI: {str(e)}"
-    except ConnectionError:
-        return "اینترنت شما قطع است!"
-    except Exception as e:
-        return f"خطای ناشناخته: {str(e)}"
 
+class Groq(OpenAICompatibleProvider):
+    name, title, model = "groq", "Groq", "llama3-8b-8192"
+    sdk = groq
 
-deepseek_user_messages = {}
+    def error_message(self, error):
+        if isinstance(error, groq.APIConnectionError):
+            return f"خطای Groq: به سرور نمیتوان وصل شد.\n{error.__cause__}"
+        if isinstance(error, groq.APIStatusError):
+            return f"خطای شماره {error.status_code}: {error.response}"
+        if isinstance(error, ConnectionError):
+            return "اینترنت شما قطع است!"
+        return super().error_message(error)
 
-def ask_deepseek(user_id, question, api_key=deepseek_api_key, max_tokens=200, model="deepseek-chat"):
-    try:
-        if user_id not in deepseek_user_messages:
-            deepseek_user_messages[user_id] = []
 
-        deepseek_user_messages[user_id].append({"role": "user", "content": question})
+class DeepSeek(Provider):
+    name, title, model = "deepseek", "DeepSeek", "deepseek-chat"
 
-        if len(deepseek_user_messages[user_id]) > 30:
-            deepseek_user_messages[user_id].pop(0)
+    def probe(self):
+        get_client(self).get(f"{DEEPSEEK_URL}/models", timeout=(self.connect_timeout, self.read_timeout)).raise_for_status()
 
-        headers = {
-            "Authorization": f"Bearer {api_key}",
-            "Content-Type": "application/json"
-        }
+    def is_retryable(self, error):
+        if isinstance(error, requests.exceptions.HTTPError) and error.response is not None:
+            return error.response.status_code == 429 or error.response.status_code >= 500
+        return isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout, requests.exceptions.ChunkedEncodingError))
 
+    def complete(self, messages, model, max_tokens, on_text=None, abort=None):
         data = {
             "model": model,
-            "messages": deepseek_user_messages[user_id],
-            "max_tokens": max_tokens
+            "messages": messages,
+            "max_tokens": max_tokens,
+            "stream": bool(on_text)
         }
-
-        response = requests.post("https://api.deepseek.com/v1/chat/completions", headers=headers, json=data)
+        session = get_client(self)
+        response = session.post(f"{DEEPSEEK_URL}/chat/completions", json=data, timeout=(self.connect_timeout, self.read_timeout), stream=bool(on_text))
         response.raise_for_status()
-
-        answer = response.json()['choices'][0]['message']['content']
-        deepseek_user_messages[user_id].append({"role": "assistant", "content": answer})
-
-        return answer.strip()
-
-    except requests.exceptions.RequestException as e:
-        return f"خطا در ارتباط با DeepSeek: {e}"
-    except Exception as e:
-        return f"خطای ناشناخته در DeepSeek: {e}"
-
-
-groq_user_messages = {}
-
-def ask_groq(user_id, question, api_key=groq_api_key, max_tokens=200, model="llama3-8b-8192"):
+        if on_text:
+            if abort:
+                abort.register(response)
+            return _stream_sse_answer(response, on_text)
+        return response.json()['choices'][0]['message']['content']
+
+    def error_message(self, error):
+        if isinstance(error, CircuitOpen):
+            return super().error_message(error)
+        if isinstance(error, requests.exceptions.RequestException):
+            return f"خطا در ارتباط با DeepSeek: {error}"
+        return f"خطای ناشناخته در DeepSeek: {error}"
+
+
+def warm_up():
+    # Open a connection to every provider that has an api key, so that the first question doesn't wait for the handshakes.
+    for provider in get_providers():
+        if not provider.available():
+            continue
+        try:
+            provider.probe()
+        except Exception as e:
+            print(f"Could not connect to {provider.name}: {e}")
+
+
+# Answers can be cached for the kinds of chat listed in cache_chat_types ("user" for private chats, "channel" for channels).
+# The key is the provider, model, max_tokens and the last cache_context messages of the chat, the question included.
+# With the default of 1 only the question itself counts, so a question that depends on earlier messages may get an answer given in another chat.
+cache_chat_types = bot.settings.get("cache_chat_types", [])
+cache_context = int(bot.settings.get("cache_context", 1))
+response_cache = ResponseCache(int(bot.settings.get("cache_size", 1000)), float(bot.settings.get("cache_ttl", 3600)))
+
+tokens_total = registry.counter("ai_tokens_total", "Estimated tokens sent to and received from AI providers, by provider and kind")
+registry.counter("ai_cache_hits_total", "Questions answered from the response cache", func=lambda: response_cache.hits)
+registry.counter("ai_cache_misses_total", "Cacheable questions that had to be asked", func=lambda: response_cache.misses)
+registry.gauge("ai_cache_entries", "Answers in the response cache", func=lambda: len(response_cache))
+
+
+def _cache_key(provider, user_id, model, max_tokens, history):
+    # Returns None when answers for this chat aren't cached.
+    if user_id.split(":", 1)[0] not in cache_chat_types:
+        return None
+    tail = tuple((message["role"], " ".join(message["content"].split()).casefold()) for message in history.tail(cache_context))
+    return (provider, model, max_tokens, tail)
+
+
+def _cached_answer(key, history, on_text):
+    # Returns the cached answer for key after recording it in the history like a real one, or None.
+    answer = response_cache.get(key) if key else None
+    if answer is not None:
+        history.append("assistant", answer)
+        if on_text:
+            on_text(answer)
+    return answer
+
+
+def create_histories(provider):
+    # The histories are saved in the bot's conversation store, and chats quiet for chat_idle_timeout seconds are only kept there.
+    return ChatHistories(provider, bot.store, history_tokens, system_prompt, float(bot.settings.get("chat_idle_timeout", 3600)))
+
+
+# Every provider's model can be changed in the settings, like "chatgpt_model": "gpt-4o".
+for provider_class, api_key in ((ChatGPT, openai_api_key), (Groq, groq_api_key), (DeepSeek, deepseek_api_key)):
+    name = provider_class.name
+    register(provider_class(
+        api_key,
+        bot.settings.get(f"{name}_model"),
+        create_histories(name),
+        connect_timeout=float(bot.settings.get(f"{name}_connect_timeout", connect_timeout)),
+        read_timeout=float(bot.settings.get(f"{name}_read_timeout", read_timeout)),
+        retries=int(bot.settings.get(f"{name}_retries", retries))
+    ))
+
+chatgpt_user_messages = get_provider("chatgpt").histories
+groq_user_messages = get_provider("groq").histories
+deepseek_user_messages = get_provider("deepseek").histories
+
+# When a provider hasn't started answering by its 95th percentile latency, the question is also sent to its fallback and the first answer wins.
+# Set hedge_fallbacks to {} to never send a question to a provider the user didn't choose.
+completer = HedgedCompleter(bot.settings.get("hedge_fallbacks", {"chatgpt": "groq", "groq": "chatgpt"}))
+registry.counter("ai_hedged_total", "Questions also sent to the fallback provider", func=lambda: completer.hedged)
+registry.counter("ai_hedges_won_total", "Hedged questions answered by the fallback provider", func=lambda: completer.hedges_won)
+registry.counter("ai_rerouted_total", "Questions sent to the fallback provider because the chosen one was down", func=lambda: completer.rerouted)
+
+
+def ask(provider_name, user_id, question, max_tokens=200, model=None, on_text=None):
+    # Ask the provider called provider_name, in the conversation of user_id. Errors are returned as the answer text.
+    provider = get_provider(provider_name)
+    model = model or provider.model
     try:
-        if user_id not in groq_user_messages:
-            groq_user_messages[user_id] = []
-
-        groq_user_messages[user_id].append({"role": "user", "content": question})
-
-        if len(groq_user_messages[user_id]) > 30:
-            groq_user_messages[user_id].pop(0)
-
-        client = groq.Groq(api_key=api_key)
-        response = client.chat.completions.create(
-            model=model,
-            messages=groq_user_messages[user_id],
-            max_tokens=max_tokens
-        )
-
-        if not response.choices:
-            return "مشکلی در دریافت پاسخ از Groq به وجود آمد!"
-
-        answer = response.choices[0].message.content
-        groq_user_messages[user_id].append({"role": "assistant", "content": answer})
+        history = provider.histories.history(user_id)
+        history.append("user", question)
+
+        cache_key = _cache_key(provider.name, user_id, model, max_tokens, history)
+        answer = _cached_answer(cache_key, history, on_text)
+        if answer is not None:
+            return answer.strip()
+
+        answer = completer.complete(provider, history.messages(), model, max_tokens, on_text)
+        tokens_total.inc(history.tokens, provider=provider.name, kind="prompt")
+        if not answer:
+            return provider.empty_message()
+        tokens_total.inc(estimate_tokens(answer), provider=provider.name, kind="completion")
+        history.append("assistant", answer)
+        if cache_key:
+            response_cache.put(cache_key, answer)
 
         return answer.strip()
 
-    except groq.APIConnectionError as e:
-        return f"خطای Groq: به سرور نمیتوان وصل شد.\n{e.__cause__}"
-    except groq.APIStatusError as e:
-        return f"خطای شماره {e.status_code}: {e.response}"
-    except ConnectionError:
-        return "اینترنت شما قطع است!"
     except Exception as e:
-        return f"خطای ناشناخته: {str(e)}"
+        return provider.error_message(e)
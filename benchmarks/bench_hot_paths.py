@@ -0,0 +1,156 @@
+"""Microbenchmarks for the code that runs on every event, with a saved baseline to catch regressions.
+
+Every case is timed in several rounds, and every round also times a fixed calibration loop right before and after it.
+A case is recorded as the median over the rounds of its time divided by that of the calibration loop.
+That number hardly depends on how fast the machine is, or how busy it is at the moment, so the baseline
+in benchmarks/baseline.json can be compared on any machine with the same Python version.
+Without --save the results are compared with the baseline, and the exit code is 1 when a case
+got slower than the baseline by more than the threshold. After a change that is meant to make a case slower,
+or on another Python version, save a new one: python benchmarks/bench_hot_paths.py --save
+
+usage: python benchmarks/bench_hot_paths.py [--save] [--threshold 1.5] [--rounds 15] [--only name]
+"""
+
+
+import sys
+import json
+import time
+import argparse
+import statistics
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import teamtalk
+from chunker import split_text
+
+BASELINE = Path(__file__).resolve().parent / "baseline.json"
+
+PERSIAN_TEXT = "سلام، این یک پیام آزمایشی طولانی است که \"نقل قول\" هم دارد و چند خط را پر می‌کند. "
+
+
+def login_dump(users=10000, channels=500):
+    # what the server sends after our login on a busy server: every channel, then every user and where they are
+    lines = [f'addchannel chanid={chanid} parentid={1 if chanid > 1 else 0} channel="/room {chanid}/" topic="topic of room {chanid}" '
+        f'password="" diskquota=0 maxusers=1000 type=0' for chanid in range(1, channels + 1)]
+    for userid in range(1, users + 1):
+        lines.append(f'loggedin userid={userid} nickname="user {userid}" username="user{userid}" ipaddr="10.0.{userid // 256}.{userid % 256}" '
+            f'version="5.12" packetprotocol=1 usertype=1 statusmode=0 statusmsg="" clientname="TeamTalk" userdata=0')
+        lines.append(f'adduser userid={userid} chanid={userid % channels + 1} sublocal=0 subpeer=0')
+    return lines
+
+
+def persian_messages(count=200):
+    content = (PERSIAN_TEXT * 12).replace('"', '\\"')
+    return [f'messagedeliver type=1 srcuserid={i} destuserid=1 content="{content}"' for i in range(count)]
+
+
+def calibration(text=PERSIAN_TEXT * 4):
+    # a fixed mix of the interpreter work the cases do: a loop, string methods, a dict and a list
+    counts = {}
+    for word in text.split():
+        counts[word] = counts.get(word, 0) + len(word.encode())
+    return sorted(counts.items())
+
+
+def loaded_server(lines):
+    # a server whose state was filled by the login dump, without connecting anywhere
+    server = teamtalk.TeamTalkServer()
+    for line in lines:
+        event, params = teamtalk.parse_tt_message(line)
+        if event == "addchannel":
+            server.channels.add(params)
+        elif event == "loggedin":
+            server.users.add(params)
+        elif event == "adduser":
+            server.users.update(params["userid"], params)
+    return server
+
+
+def cases():
+    # name -> (function, list of argument tuples); each call of the function with one of the tuples is one operation
+    dump = login_dump()
+    messages = persian_messages()
+    server = loaded_server(dump)
+    userids = list(range(1, 10001, 7))
+    nicknames = [f"user {userid}" for userid in userids]
+    chanids = list(range(1, 501, 3))
+    channel_names = [f"/room {chanid}/" for chanid in chanids]
+    replies = [("message", {"type": teamtalk.USER_MSG, "destuserid": i, "content": PERSIAN_TEXT * 3}) for i in range(200)]
+    answers = [PERSIAN_TEXT * count for count in (1, 5, 20, 60)]
+    return {
+        "parse_tt_message login dump": (teamtalk.parse_tt_message, [(line,) for line in dump]),
+        "parse_tt_message persian": (teamtalk.parse_tt_message, [(line,) for line in messages]),
+        "split_quoted persian": (teamtalk.split_quoted, [(line,) for line in messages]),
+        "build_tt_message persian": (teamtalk.build_tt_message, replies),
+        "build_tt_message ping": (teamtalk.build_tt_message, [("ping", {})] * 100),
+        "split_text persian": (lambda text: list(split_text(text)), [(answer,) for answer in answers]),
+        "get_user by id": (server.get_user, [(userid,) for userid in userids]),
+        "get_user by nickname": (server.get_user, [(nickname,) for nickname in nicknames]),
+        "get_channel by id": (server.get_channel, [(chanid,) for chanid in chanids]),
+        "get_channel by name": (server.get_channel, [(name,) for name in channel_names]),
+        "get_users_in_channel": (server.get_users_in_channel, [(chanid,) for chanid in chanids]),
+    }
+
+
+def timed(func, arguments, min_time):
+    # Seconds per operation, calling func with every argument tuple until min_time seconds have passed.
+    operations = 0
+    start = time.perf_counter()
+    while True:
+        for args in arguments:
+            func(*args)
+        operations += len(arguments)
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            return elapsed / operations
+
+
+def measure(func, arguments, rounds, min_time=0.05):
+    # Returns the best nanoseconds per operation, and the median number of calibration loops one operation takes.
+    best = None
+    relative = []
+    for _ in range(rounds):
+        before = timed(calibration, [()], min_time)
+        result = timed(func, arguments, min_time)
+        after = timed(calibration, [()], min_time)
+        best = result if best is None else min(best, result)
+        relative.append(result / min(before, after))
+    return best * 1e9, statistics.median(relative)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--save", action="store_true", help="save the results as the new baseline")
+    parser.add_argument("--threshold", type=float, default=1.5, help="fail when a case takes this many times as long as its baseline")
+    parser.add_argument("--rounds", type=int, default=15)
+    parser.add_argument("--only", help="run only the cases whose name contains this")
+    args = parser.parse_args()
+
+    baseline = json.loads(BASELINE.read_text()) if BASELINE.exists() else {}
+    results = {}
+    regressions = []
+    for name, (func, arguments) in cases().items():
+        if args.only and args.only not in name:
+            continue
+        nanoseconds, result = measure(func, arguments, args.rounds)
+        results[name] = result
+        line = f"{name:30} {nanoseconds:12,.0f} ns/op {result:10.3f} calibrations"
+        if name in baseline:
+            ratio = result / baseline[name]
+            line += f"  {ratio:5.2f}x baseline"
+            if ratio > args.threshold:
+                line += "  SLOWER"
+                regressions.append(name)
+        print(line)
+
+    if args.save:
+        baseline.update(results)
+        BASELINE.write_text(json.dumps(baseline, indent=1, ensure_ascii=False) + "\n")
+        print(f"saved {BASELINE}")
+    elif regressions:
+        print(f"{len(regressions)} case(s) slower than {args.threshold}x their baseline: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""Compares the throughput of teamtalk.parse_tt_message with the character by character parser it replaced.
+
+usage: python benchmarks/bench_parser.py [seconds per case]
+"""
+
+
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import teamtalk
+
+
+def legacy_split_quoted(message):
+    pos = -1
+    inquote = False
+    buffer = ""
+    final = []
+    while pos < len(message)-1:
+        pos += 1
+        token = message[pos]
+        if token == " " and not inquote:
+            final.append(buffer)
+            buffer = ""
+            continue
+        if token == "\"" and message[pos-1] != "\\":
+            inquote = not inquote
+        buffer += token
+    final.append(buffer)
+    return final
+
+
+def legacy_parse_tt_message(message):
+    params = {}
+    message = message.strip()
+    message = legacy_split_quoted(message)
+    event = message[0]
+    message.remove(event)
+    for item in message:
+        k, v = teamtalk.split_parts(item)
+        if v.startswith("[") and v.endswith("]"):
+            v = v.strip("[]")
+            if v:
+                v = [int(val) if val.isdigit() else val for val in v.split(",")]
+            else:
+                v = []
+        elif v.isdigit():
+            v = int(v)
+        elif v.startswith('"') and v.endswith('"'):
+            v = v[1:-1]
+        params[k] = v
+    return event, params
+
+
+def login_flood(users=1000):
+    # what the server sends for every logged in user after our own login
+    lines = []
+    for userid in range(1, users + 1):
+        lines.append(f'loggedin userid={userid} nickname="user {userid}" username="user{userid}" ipaddr="10.0.{userid // 256}.{userid % 256}" '
+            f'version="5.12" packetprotocol=1 usertype=1 statusmode=0 statusmsg="" clientname="TeamTalk" userdata=0')
+        lines.append(f'adduser userid={userid} chanid={userid % 50 + 1} sublocal=0 subpeer=0')
+    return lines
+
+
+def long_messages(count=200):
+    text = "سلام، این یک پیام آزمایشی طولانی است که \\\"نقل قول\\\" هم دارد. " * 12
+    return [f'messagedeliver type=1 srcuserid={i} destuserid=1 content="{text}"' for i in range(count)]
+
+
+def measure(parse, lines, seconds):
+    parsed = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        for line in lines:
+            parse(line)
+        parsed += len(lines)
+    return parsed / (time.perf_counter() - start)
+
+
+def main():
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 1.0
+    cases = {"login flood": login_flood(), "long messagedeliver": long_messages()}
+    for name, lines in cases.items():
+        legacy = measure(legacy_parse_tt_message, lines, seconds)
+        current = measure(teamtalk.parse_tt_message, lines, seconds)
+        print(f"{name}: legacy {legacy:,.0f} lines/s, current {current:,.0f} lines/s ({current / legacy:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
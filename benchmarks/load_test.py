@@ -0,0 +1,165 @@
+"""Runs the bot against the mock TeamTalk server and the mock LLM server, and measures how fast it answers.
+
+Every simulated user picks an AI, then asks its questions one after another, each as soon as the previous answer is complete.
+The bot runs in its own process with a temporary home directory, so the real settings and conversations are never touched.
+Reports the answered questions per second and the p50/p99 latency to the first reply and to the complete answer.
+
+usage: python benchmarks/load_test.py --users 50 --questions 5 --latency 0.5 --error-rate 0.05
+"""
+
+
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+import subprocess
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+from mock_llm import MockLLMServer, ANSWER_END
+from mock_teamtalk import MockTeamTalkServer
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def percentile(values, percent):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+class LoadTest:
+    def __init__(self, args):
+        self.args = args
+        self.llm = MockLLMServer(latency=args.latency, token_delay=args.token_delay, words=args.words, error_rate=args.error_rate)
+        self.teamtalk = MockTeamTalkServer(users=args.users, flood_rate=args.flood_rate, on_message=self.on_message)
+        # simulated userid -> queue of the messages the bot sent to that user
+        self.replies = {userid: asyncio.Queue() for userid in self.teamtalk.users}
+        self.first_reply = []
+        self.complete = []
+        self.failed = 0
+        self.timeouts = 0
+
+    def on_message(self, client, params):
+        queue = self.replies.get(params.get("destuserid"))
+        if queue:
+            queue.put_nowait((time.perf_counter(), params.get("content", "")))
+
+    def write_settings(self, home, teamtalk_port):
+        settings = dict(
+            openai_api_key="mock",
+            groq_api_key="mock",
+            host="127.0.0.1",
+            port=teamtalk_port,
+            username="bot",
+            password="bot",
+            nickname="bot",
+            channel="/",
+            channel_password="",
+            store_path="",
+            ai_warm_up=False,
+        )
+        settings.update(json.loads(self.args.settings))
+        with open(Path(home) / ".tt-ai-bot.json", "w") as settings_file:
+            json.dump(settings, settings_file)
+
+    def start_bot(self, home, llm_port):
+        env = dict(os.environ, HOME=home, OPENAI_BASE_URL=f"http://127.0.0.1:{llm_port}/v1", GROQ_BASE_URL=f"http://127.0.0.1:{llm_port}")
+        command = self.args.bot_command.split() if self.args.bot_command else [sys.executable, str(ROOT / "main.py"), "run"]
+        log = open(Path(home) / "bot.log", "w")
+        return subprocess.Popen(command, cwd=ROOT, env=env, stdin=subprocess.PIPE, stdout=log, stderr=subprocess.STDOUT)
+
+    async def wait_for_bot(self, process, timeout=30):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError(f"the bot exited with code {process.returncode}")
+            for client in self.teamtalk.clients.values():
+                if client.chanid:
+                    return client
+            await asyncio.sleep(0.1)
+        raise TimeoutError("the bot didn't join the channel in time")
+
+    async def wait_for_answer(self, queue, sent):
+        # Returns True once the whole answer arrived. An answer without ANSWER_END, like an error message, is over when the bot stays quiet for settle seconds.
+        first = None
+        deadline = sent + self.args.timeout
+        while True:
+            timeout = deadline - time.perf_counter()
+            if first is not None:
+                timeout = min(timeout, self.args.settle)
+            try:
+                received, content = await asyncio.wait_for(queue.get(), max(timeout, 0))
+            except asyncio.TimeoutError:
+                if first is None:
+                    self.timeouts += 1
+                else:
+                    self.first_reply.append(first - sent)
+                    self.failed += 1
+                return False
+            if first is None:
+                first = received
+            if ANSWER_END in content:
+                self.first_reply.append(first - sent)
+                self.complete.append(received - sent)
+                return True
+
+    async def user(self, client, userid):
+        queue = self.replies[userid]
+        self.teamtalk.deliver(userid, self.args.provider, client)
+        await queue.get()
+        for number in range(self.args.questions):
+            sent = time.perf_counter()
+            self.teamtalk.deliver(userid, f"question {number} from user {userid}", client)
+            await self.wait_for_answer(queue, sent)
+
+    async def run(self):
+        llm_port = await self.llm.start()
+        teamtalk_port = await self.teamtalk.start()
+        with tempfile.TemporaryDirectory() as home:
+            self.write_settings(home, teamtalk_port)
+            process = self.start_bot(home, llm_port)
+            try:
+                client = await self.wait_for_bot(process)
+                start = time.perf_counter()
+                await asyncio.gather(*(self.user(client, userid) for userid in self.teamtalk.users))
+                elapsed = time.perf_counter() - start
+            finally:
+                process.terminate()
+                process.wait()
+                await self.teamtalk.stop()
+                await self.llm.stop()
+        self.report(elapsed)
+
+    def report(self, elapsed):
+        asked = self.args.users * self.args.questions
+        print(f"{self.args.users} users asked {asked} questions in {elapsed:.1f}s")
+        print(f"answered: {len(self.complete)} ({len(self.complete) / elapsed:.2f} answers/s), failed: {self.failed}, timed out: {self.timeouts}")
+        print(f"first reply: p50 {percentile(self.first_reply, 50):.3f}s, p99 {percentile(self.first_reply, 99):.3f}s")
+        print(f"complete answer: p50 {percentile(self.complete, 50):.3f}s, p99 {percentile(self.complete, 99):.3f}s")
+        print(f"LLM requests: {self.llm.requests}, failed on purpose: {self.llm.errors}, command floods: {self.teamtalk.floods}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--questions", type=int, default=5, help="questions per user")
+    parser.add_argument("--provider", default="1", help="the menu number the users send to choose an AI")
+    parser.add_argument("--latency", type=float, default=0.5, help="seconds until the mock LLM starts answering")
+    parser.add_argument("--token-delay", type=float, default=0.02, help="seconds between streamed words")
+    parser.add_argument("--words", type=int, default=40, help="words per answer")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of LLM requests that fail")
+    parser.add_argument("--flood-rate", type=float, default=0, help="commands per second the mock TeamTalk server allows, 0 for no limit")
+    parser.add_argument("--timeout", type=float, default=60, help="seconds to wait for an answer")
+    parser.add_argument("--settle", type=float, default=2, help="seconds of quiet that end an answer without the end marker")
+    parser.add_argument("--settings", default="{}", help="JSON object of bot settings to override")
+    parser.add_argument("--bot-command", help="command that starts the bot, python main.py run by default")
+    asyncio.run(LoadTest(parser.parse_args()).run())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""An HTTP server that answers like the OpenAI chat completions API, which Groq and DeepSeek copy.
+
+The answers are generated, they take latency seconds to start and token_delay seconds per streamed word,
+and error_rate of the requests fail with a 429 or a 500. Every answer ends with ANSWER_END, so a client can tell
+when the whole of it has arrived. Point the bot at it with OPENAI_BASE_URL=http://127.0.0.1:<port>/v1
+and GROQ_BASE_URL=http://127.0.0.1:<port>.
+
+usage: python benchmarks/mock_llm.py [port] [latency] [error rate]
+"""
+
+
+import sys
+import json
+import time
+import random
+import asyncio
+
+
+ANSWER_END = "[done]"
+
+
+class MockLLMServer:
+    def __init__(self, latency=0.5, jitter=0.2, token_delay=0.02, words=40, error_rate=0.0):
+        self.latency = latency
+        # the latency of every request is drawn between latency * (1 - jitter) and latency * (1 + jitter)
+        self.jitter = jitter
+        self.token_delay = token_delay
+        self.words = words
+        self.error_rate = error_rate
+        self.requests = 0
+        self.errors = 0
+        self.active = 0
+        self._server = None
+        self._tasks = set()
+
+    async def start(self, host="127.0.0.1", port=0):
+        self._server = await asyncio.start_server(self._serve, host, port)
+        return self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self._server.close()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        await self._server.wait_closed()
+
+    def answer(self, question):
+        words = [f"word{number}" for number in range(self.words)]
+        return f"Answer to {question[:40]!r}: " + " ".join(words) + ". " + ANSWER_END
+
+    async def _serve(self, reader, writer):
+        # one connection may carry many requests, like the keep-alive connections of the clients' pools
+        self._tasks.add(asyncio.current_task())
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode().split(" ", 2)
+                headers = {}
+                while True:
+                    line = (await reader.readline()).decode().strip()
+                    if not line:
+                        break
+                    name, _, value = line.partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                await self._handle(writer, method, path, json.loads(body) if body else {})
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError, ValueError):
+            pass
+        finally:
+            self._tasks.discard(asyncio.current_task())
+            writer.close()
+
+    async def _handle(self, writer, method, path, request):
+        if path.rstrip("/").endswith("/models"):
+            self._respond(writer, 200, {"object": "list", "data": [{"id": "mock", "object": "model", "owned_by": "mock"}]})
+            return
+        if method != "POST" or not path.rstrip("/").endswith("/chat/completions"):
+            self._respond(writer, 404, {"error": {"message": f"{path} not found", "type": "invalid_request_error"}})
+            return
+        self.requests += 1
+        self.active += 1
+        try:
+            await asyncio.sleep(self.latency * random.uniform(1 - self.jitter, 1 + self.jitter))
+            if random.random() < self.error_rate:
+                self.errors += 1
+                status = random.choice((429, 500))
+                self._respond(writer, status, {"error": {"message": "mock failure", "type": "rate_limit_error" if status == 429 else "server_error"}})
+                return
+            messages = request.get("messages") or [{"content": ""}]
+            answer = self.answer(messages[-1].get("content", ""))
+            model = request.get("model", "mock")
+            if request.get("stream"):
+                await self._stream(writer, model, answer)
+            else:
+                self._respond(writer, 200, {
+                    "id": f"chatcmpl-{self.requests}",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": model,
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": answer}, "finish_reason": "stop"}],
+                    "usage": {"prompt_tokens": 0, "completion_tokens": len(answer.split()), "total_tokens": len(answer.split())},
+                })
+        finally:
+            self.active -= 1
+        await writer.drain()
+
+    def _respond(self, writer, status, data):
+        body = json.dumps(data).encode()
+        writer.write(f"HTTP/1.1 {status} MOCK\r\nContent-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body)
+
+    async def _stream(self, writer, model, answer):
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nTransfer-Encoding: chunked\r\n\r\n")
+        created = int(time.time())
+        for word in answer.split(" "):
+            chunk = {
+                "id": f"chatcmpl-{self.requests}",
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "delta": {"content": word + " "}, "finish_reason": None}],
+            }
+            self._write_chunk(writer, f"data: {json.dumps(chunk)}\n\n")
+            await writer.drain()
+            if self.token_delay:
+                await asyncio.sleep(self.token_delay)
+        self._write_chunk(writer, "data: [DONE]\n\n")
+        writer.write(b"0\r\n\r\n")
+
+    @staticmethod
+    def _write_chunk(writer, text):
+        data = text.encode()
+        writer.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+
+
+async def main():
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8000
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.5
+    error_rate = float(sys.argv[3]) if len(sys.argv) > 3 else 0.0
+    server = MockLLMServer(latency=latency, error_rate=error_rate)
+    port = await server.start(port=port)
+    print(f"mock LLM server listening on http://127.0.0.1:{port}/v1")
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,175 @@
+"""A TeamTalk server that only speaks enough of the text protocol to run the bot against it.
+
+Every client that logs in gets a login flood for the simulated users, all of them in the root channel,
+and can join that channel and send messages. Messages to the simulated users are handed to on_message,
+and deliver() sends messages from them. Clients sending more than flood_rate commands per second get
+the same command flood error a real server sends.
+
+usage: python benchmarks/mock_teamtalk.py [port] [users]
+"""
+
+
+import sys
+import time
+import asyncio
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import teamtalk
+
+
+CHANNEL_ID = 1
+
+
+class Client:
+    def __init__(self, server, userid, writer):
+        self.server = server
+        self.userid = userid
+        self.writer = writer
+        self.username = ""
+        self.logged_in = False
+        self.chanid = None
+        # command flood detection, the same token bucket the client library uses for its own rate limit
+        self.bucket = teamtalk.TokenBucket(server.flood_rate, server.flood_burst) if server.flood_rate else None
+
+    def send(self, event, params=None):
+        self.writer.write(self.server.encode(event, params or {}))
+
+
+class MockTeamTalkServer:
+    def __init__(self, users=100, flood_rate=0, flood_burst=20, on_message=None):
+        # simulated userid -> username, they use ids from 1000 up so they can't collide with real clients
+        self.users = {1000 + number: f"user{number}" for number in range(users)}
+        self.flood_rate = flood_rate
+        self.flood_burst = flood_burst
+        # called with (client, params) for every message a client sends to a simulated user or the channel
+        self.on_message = on_message
+        self.clients = {}
+        self.floods = 0
+        self.lines_received = 0
+        self._next_userid = 1
+        self._server = None
+        self._tasks = set()
+
+    @staticmethod
+    def encode(event, params):
+        return (teamtalk.build_tt_message(event, params) + "\r\n").encode()
+
+    async def start(self, host="127.0.0.1", port=0):
+        self._server = await asyncio.start_server(self._serve, host, port, limit=2**20)
+        return self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self._server.close()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        await self._server.wait_closed()
+
+    def deliver(self, srcuserid, content, client=None, type=teamtalk.USER_MSG):
+        # Sends a message from a simulated user to a client, or to every logged in client.
+        clients = [client] if client else [other for other in self.clients.values() if other.logged_in]
+        for other in clients:
+            params = {"type": type, "srcuserid": srcuserid, "content": content}
+            if type == teamtalk.USER_MSG:
+                params["destuserid"] = other.userid
+            else:
+                params["chanid"] = CHANNEL_ID
+            other.send("messagedeliver", params)
+
+    async def _serve(self, reader, writer):
+        client = Client(self, self._next_userid, writer)
+        self._next_userid += 1
+        self.clients[client.userid] = client
+        self._tasks.add(asyncio.current_task())
+        client.send("teamtalk", {"userid": client.userid, "servername": "mock", "usertimeout": 60, "protocol": "5.6"})
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                self.lines_received += 1
+                event, params = teamtalk.parse_tt_message(line.decode())
+                self._handle(client, event, params)
+                await writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            del self.clients[client.userid]
+            self._tasks.discard(asyncio.current_task())
+            writer.close()
+
+    def _handle(self, client, event, params):
+        id = params.get("id")
+        if client.bucket:
+            now = time.monotonic()
+            if client.bucket.wait_time(now):
+                self.floods += 1
+                client.send("error", {"number": teamtalk.CMD_ERR_COMMAND_FLOOD, "message": "Command flooding prevented by server"})
+                return
+            client.bucket.take(now)
+        if event == "ping":
+            client.send("pong")
+            return
+        if event == "quit":
+            client.send("loggedout")
+            client.writer.close()
+            return
+        if id:
+            client.send("begin", {"id": id})
+        handler = getattr(self, f"_handle_{event}", None)
+        if handler:
+            handler(client, params)
+            client.send("ok")
+        else:
+            client.send("error", {"number": teamtalk.CMD_ERR_UNKNOWN_COMMAND, "message": "Command not found"})
+        if id:
+            client.send("end", {"id": id})
+
+    def _handle_login(self, client, params):
+        client.username = params.get("username", "")
+        client.logged_in = True
+        client.send("accepted", {"userid": client.userid, "username": client.username, "nickname": params.get("nickname", ""), "usertype": 1})
+        client.send("serverupdate", {"servername": "mock", "usertimeout": 60, "maxusers": 1000})
+        client.send("addchannel", {"chanid": CHANNEL_ID, "channel": "/", "topic": "", "password": "", "maxusers": 1000})
+        for userid, username in self.users.items():
+            client.send("loggedin", {"userid": userid, "username": username, "nickname": username, "ipaddr": "127.0.0.1", "statusmode": 0, "statusmsg": ""})
+            client.send("adduser", {"userid": userid, "chanid": CHANNEL_ID})
+        for other in self.clients.values():
+            if other.logged_in and other is not client:
+                client.send("loggedin", {"userid": other.userid, "username": other.username, "nickname": other.username})
+
+    def _handle_join(self, client, params):
+        client.chanid = CHANNEL_ID
+        client.send("joined", {"chanid": CHANNEL_ID})
+        client.send("adduser", {"userid": client.userid, "chanid": CHANNEL_ID})
+
+    def _handle_leave(self, client, params):
+        client.chanid = None
+        client.send("left", {"chanid": CHANNEL_ID})
+
+    def _handle_message(self, client, params):
+        if self.on_message:
+            self.on_message(client, params)
+
+    def _handle_changestatus(self, client, params):
+        pass
+
+    def _handle_changenick(self, client, params):
+        pass
+
+
+async def main():
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 10333
+    users = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    server = MockTeamTalkServer(users, on_message=lambda client, params: print(f"{client.username}: {params}"))
+    port = await server.start(port=port)
+    print(f"mock TeamTalk server with {users} users listening on port {port}")
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
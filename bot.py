@@ -6,24 +6,87 @@
 import sys
 import json
 import time
+import random
 import teamtalk
-from threading import Thread
+import metrics
+from profiling import SlowHandlerLog, DispatchProfiler, sample_threads
+from workers import ChatWorkerPool
+from chunker import StreamChunker, split_text
+from store import ConversationStore, ChatChoices
+from threading import Thread, Lock, Event
+from collections import deque
 from pathlib import Path
-import textwrap
 
 
 class Bot(teamtalk.TeamTalkServer):
+    # Put in front of the user or channel in every chat_id, so chats of different servers in one process never mix. Empty for a single server.
+    chat_prefix = ""
+    # The name the metrics of the server connection are recorded under.
+    metrics_prefix = "teamtalk"
+
     def __init__(self):
         super().__init__()
         # Call a function to load settings needed for running the bot like teamtalk account and api keys
         self.load_settings()
         # Comment the next line if you don't want to save the bot info like teamtalk account and api keys on your disk.
         self.save_settings()
+        # Every subscriber call slower than slow_handler_threshold seconds is printed with its event, it holds up reading from the server.
+        self.slow_handlers = SlowHandlerLog(float(self.settings.get("slow_handler_threshold", 0.2)))
+        # Admins can profile the subscribers at runtime by sending "profile" to the bot, see run_profile.
+        self.dispatch_profiler = DispatchProfiler()
+        self.configure_server()
+        # Conversations and the AI every chat has chosen are saved on disk, so they survive restarts of the bot.
+        # Set store_path to an empty string to keep them in memory only, then idle chats are forgotten.
+        store_path = self.settings.get("store_path", str(Path.home() / '.tt-ai-bot.db'))
+        self.store = ConversationStore(store_path) if store_path else None
+        # Remember which user talks to which AI. Chats that were quiet for chat_idle_timeout seconds are only kept in the store.
+        self.chats = ChatChoices(self.store, float(self.settings.get("chat_idle_timeout", 3600)))
+        # A fixed number of threads answers the AI questions instead of one new thread per message.
+        # Messages of one chat are answered one by one in the order they arrived, different chats are answered in parallel.
+        self.ai_workers = ChatWorkerPool(
+            workers=int(self.settings.get("ai_workers", 8)),
+            max_pending=int(self.settings.get("ai_queue_size", 100)),
+        )
+        self.ai_workers.start()
+        # Counters, gauges and histograms about the server and the AI are kept in metrics.registry. Admins (a list of usernames in the admins setting) can get them
+        # by sending "metrics" to the bot in a private message, and with metrics_port they are served at http://127.0.0.1:<port>/metrics
+        metrics.registry.gauge("ai_workers_running", "AI questions being answered", func=lambda: self.ai_workers.running)
+        metrics.registry.gauge("ai_workers_pending", "AI questions waiting for a worker", func=lambda: self.ai_workers.pending)
+        metrics.registry.counter("ai_workers_rejected_total", "AI questions refused because too many were waiting", func=lambda: self.ai_workers.rejected)
+        metrics.registry.gauge("chats_in_memory", "Chats whose AI choice is loaded", func=lambda: len(self.chats))
+        metrics_port = int(self.settings.get("metrics_port", 0))
+        if metrics_port:
+            metrics.registry.serve(metrics_port)
+
+    def configure_server(self):
+        # Everything that belongs to the connection rather than to the bot, HostedBot calls it for each of its connections.
         # This function ensures that for each message the assigned function will be called.
         # It's like the events in javascript
         self.subscribe("messagedeliver", self.on_message_deliver)
-        # Creat a dictionary to remember which user talks to which AI
-        self.chats = {}
+        # The bot never looks at the files of channels, so we don't keep track of them and their events are not even parsed.
+        self.set_state_tracking(files=False)
+        self.set_metrics(metrics.registry, self.metrics_prefix)
+        self.add_middleware(self.slow_handlers)
+        self.add_middleware(self.dispatch_profiler)
+        # In multi channel mode (the channels setting, a list of channel paths) the bot also answers in those channels without joining them.
+        # It intercepts the channel messages of everyone in them, which needs an admin account, and answers there with its admin rights.
+        # userids whose channel messages are intercepted
+        self.intercepted = set()
+        self.subscribe("adduser", self.on_user_moved)
+        self.subscribe("removeuser", self.on_user_moved)
+        self.subscribe("loggedout", self.on_user_moved)
+        self.subscribe("joined", self.intercept_channels)
+        # see migrate_channel_chats
+        self.channel_chats_migrated = False
+        # When the connection drops the bot connects again by itself, see supervise. Until it is back, answers wait in the outbox.
+        self.connected = False
+        self.outbox = deque()
+        self.outbox_lock = Lock()
+        # set by restart_bot to connect again without waiting
+        self.reconnect_now = Event()
+        self.connection_failures = metrics.registry.counter(f"{self.metrics_prefix}_connection_failures_total", "Connections that were lost or could not be made")
+        metrics.registry.gauge(f"{self.metrics_prefix}_connected", "1 while the bot is connected and logged in", func=lambda: int(self.connected))
+        metrics.registry.gauge(f"{self.metrics_prefix}_outbox", "Answers waiting for the bot to connect again", func=lambda: len(self.outbox))
 
     def load_settings(self):
         # Generate a default address for storing bot settings like teamtalk account info and api keys
@@ -81,60 +144,215 @@ class Bot(teamtalk.TeamTalkServer):
             json.dump(self.settings, settings_file, indent=True)
     
     def start_bot(self):
-        # This function start the bot by connecting to the teamtalk server if the account info is correct.
+        # This function start the bot. Connecting, reading from the server and connecting again when the connection drops all happen in a thread, to avoid blocking main thread.
+        Thread(target=self.supervise, daemon=True).start()
+
+    def connect_bot(self):
+        # Connect to the teamtalk server, log in and join the channel. Raises an exception if the server can't be reached or refuses the account.
         host, port = self.settings["host"], self.settings["port"]
         self.set_connection_info(host, port)
         self.connect()
         username, password = self.settings["username"], self.settings["password"]
         nickname, app_name = self.settings["nickname"], "tt_bot"
         self.login(nickname, username, password, app_name)
+        self.check_login()
+        self.migrate_channel_chats()
         channel, channel_password = self.settings["channel"], self.settings["channel_password"]
         if channel:
             self.join(channel, channel_password)
-        # this last function ensures that bot can read and write to teamtalk server. we put in a thread to avoid blocking main thread.
-        Thread(target=self.handle_messages, args=(1,), daemon=True).start()
+        self.flush_outbox()
+
+    def supervise(self):
+        # Keep the bot connected: every time the connection drops or can't be made, wait a little and connect again.
+        # The chats, the conversations and the questions the AI workers are answering are not touched by any of this.
+        failures = 0
+        while True:
+            try:
+                self.connect_bot()
+                failures = 0
+                print("Connected.")
+                # this function ensures that bot can read and write to teamtalk server, it returns when the connection is over.
+                self.handle_messages(1)
+            except Exception as error:
+                failures += 1
+                print(f"Connecting to the server failed: {error!r}")
+            self.connection_closed()
+            if self.con:
+                self.disconnect()
+            delay = self.reconnect_delay(failures)
+            print(f"Connecting again in {delay:.1f} seconds.")
+            self.reconnect_now.wait(delay)
+            self.reconnect_now.clear()
+            self.reset()
 
     def restart_bot(self):
-        if not self.disconnecting:
+        # Drop the connection and connect again right away, supervise does the rest.
+        self.reconnect_now.set()
+        if self.con and not self.disconnecting:
             self.disconnect()
-        # sleep for three seconds to bot handles the disconnecting status
-        time.sleep(3)
-        super().__init__()
-        self.subscribe("messagedeliver", self.on_message_deliver)
-        self.start_bot()
-        
+
+    def check_login(self):
+        # login returns once the server has answered, also when the answer was an error.
+        if self.disconnecting:
+            raise ConnectionError("the connection was lost while logging in")
+        if "userid" not in self.me:
+            raise ConnectionError("the server refused the login")
+
+    def migrate_channel_chats(self):
+        # Channel chats used to be saved under the chanid of the channel, which the server may give to another channel after a restart.
+        # Now they are saved under its path. On the first login the chats saved the old way are moved to the path their chanid has now,
+        # those whose chanid doesn't exist any more are left alone.
+        if self.store is None or self.channel_chats_migrated:
+            return
+        self.channel_chats_migrated = True
+        prefix = f"channel:{self.chat_prefix}"
+        for chat_id in self.store.chat_ids(prefix):
+            chanid = chat_id[len(prefix):]
+            channel = self.get_channel(int(chanid)) if chanid.isdigit() else None
+            if channel:
+                self.store.rename_chat(chat_id, prefix + channel["channel"])
+
+    def reconnect_delay(self, failures):
+        # Seconds to wait before connecting again: random, so bots that lost a restarting server don't all come back at the same moment,
+        # and doubled after every failed attempt, from reconnect_delay up to reconnect_max_delay.
+        delay = float(self.settings.get("reconnect_delay", 2)) * 2 ** failures
+        return random.uniform(0, min(float(self.settings.get("reconnect_max_delay", 60)), delay))
+
+    def connection_closed(self):
+        # From now on answers wait in the outbox. The new connection will have no intercept subscriptions.
+        with self.outbox_lock:
+            self.connected = False
+        self.intercepted.clear()
+        self.connection_failures.inc()
+
+    def hold_response(self, message_type, username, message, channel):
+        # Keep an answer that was finished while the bot is away, it is sent by flush_outbox. Returns False if the bot is connected after all.
+        # The connection counts as gone as soon as it is disconnecting, before supervise gets to call connection_closed.
+        with self.outbox_lock:
+            if self.connected and not self.disconnecting:
+                return False
+            if message_type == teamtalk.CHANNEL_MSG:
+                channel = channel or self.settings.get("channel")
+            if len(self.outbox) >= int(self.settings.get("outbox_size", 100)) or (message_type == teamtalk.CHANNEL_MSG and not channel):
+                print(f'The bot is reconnecting, an answer to "{username}" was dropped.')
+                return True
+            self.outbox.append((time.monotonic(), message_type, username, channel, message))
+        return True
+
+    def flush_outbox(self):
+        # Send the answers held while the bot was away, the ones older than outbox_ttl seconds are dropped. Then answers are sent directly again.
+        ttl = float(self.settings.get("outbox_ttl", 300))
+        while True:
+            with self.outbox_lock:
+                if not self.outbox:
+                    self.connected = True
+                    return
+                held, message_type, username, channel, message = self.outbox.popleft()
+            if time.monotonic() - held > ttl or self.deliver_response(message_type, username, message, channel) is False:
+                print(f'An answer to "{username}" was dropped, it is too old or its user or channel is gone.')
+
     def split_long_text(self, text):
-        # Because of teamtalk limits for message length, We split it to smaller line and send it in several messages if necessary
-        short_texts = []
-        text_lines = textwrap.wrap(text, width=250)
-        text_buffer = ''
-        while text_lines:
-            if len(text_buffer + text_lines[0]) > 250:
-                short_texts.append(text_buffer.strip())
-                text_buffer = ''
-            else:
-                text_buffer += text_lines.pop(0) + '\n'
-                if not text_lines:
-                    short_texts.append(text_buffer.strip())
-        return short_texts
+        # Because of teamtalk limits for message length, We split it to smaller parts and send it in several messages if necessary.
+        # The limit is in UTF-8 bytes, which is what the server counts, and the lines of the text are kept.
+        return list(split_text(text, self.settings.get("message_bytes", 500)))
+
+    def send_response(self, message_type, username, message, channel=None):
+        # Send a response message to the user with username, or to a channel. channel is the path of the channel the question came from (the bot's own channel if None).
+        # Usernames and paths stay the same when the bot connects again, unlike userids and chanids, so an answer can outlive the connection of its question.
+        # While the bot is reconnecting, the message waits in the outbox instead.
+        if (not self.connected or self.disconnecting) and self.hold_response(message_type, username, message, channel):
+            return
+        if self.deliver_response(message_type, username, message, channel) is False and not self.hold_response(message_type, username, message, channel):
+            print(f'An answer to "{username}" was dropped, its user or channel is gone.')
 
-    def send_response(self, message_type, user, message):
-        # Send a response message to a user or channel
+    def deliver_response(self, message_type, username, message, channel):
+        # Returns False if the message couldn't be sent.
         if message_type == teamtalk.USER_MSG:
-            self.user_message(user, message)
+            # The userid is looked up now, because the user gets a new one when either side connects again.
+            user = self.get_user_by_username(username)
+            if user is None:
+                return False
+            return self.user_message(user, message)
         elif message_type == teamtalk.CHANNEL_MSG:
-            self.channel_message(message)
+            # The chanid is looked up now, because the channel gets a new one when the bot connects again.
+            chanid = self.get_channel(channel, index=True) if channel else None
+            if channel and chanid is None:
+                return False
+            return self.channel_message(message, chanid)
+
+    def served_channels(self):
+        # The chanids of the channels the bot answers in: its own channel and, in multi channel mode, those of the channels setting that exist.
+        chanids = {self.me.get("chanid")}
+        for channel in self.settings.get("channels", []):
+            chanid = self.get_channel(channel, index=True)
+            if chanid is not None:
+                chanids.add(chanid)
+        return chanids
+
+    def intercept_channel(self, user, served=None):
+        # Intercept the channel messages of user while they are in a served channel other than the bot's own, where they reach the bot anyway.
+        # Only admins may intercept, the server refuses the command of anybody else.
+        userid, chanid = user.get("userid"), user.get("chanid")
+        wanted = (self.settings.get("channels") and self.get_role() == "admin" and userid != self.me.get("userid") and chanid is not None
+            and chanid != self.me.get("chanid") and chanid in (served or self.served_channels()))
+        # There is one command per user, all of them at once after joining, so they are paced like chat messages to not trip the flood protection.
+        if wanted and userid not in self.intercepted:
+            self.intercepted.add(userid)
+            self.subscribe_to(userid, teamtalk.SUBSCRIBE_INTERCEPT_CHANNEL_MSG, priority=teamtalk.PRIORITY_BULK)
+        elif not wanted and userid in self.intercepted:
+            self.intercepted.discard(userid)
+            self.unsubscribe_from(userid, teamtalk.SUBSCRIBE_INTERCEPT_CHANNEL_MSG, priority=teamtalk.PRIORITY_BULK)
+
+    def intercept_channels(self, server=None, params=None):
+        # Check everybody in the served channels and everybody intercepted already, after the bot joined a channel.
+        if not self.settings.get("channels"):
+            return
+        if self.get_role() != "admin":
+            print("Multi channel mode needs an admin account, only the messages of the bot's own channel will be answered.")
+            return
+        served = self.served_channels()
+        for chanid in served:
+            for user in self.users.find_all("chanid", chanid):
+                self.intercept_channel(user, served)
+        for userid in list(self.intercepted):
+            user = self.get_user(userid)
+            if user:
+                self.intercept_channel(user, served)
+            else:
+                self.intercepted.discard(userid)
+
+    def on_user_moved(self, server, params):
+        # A user joined or left a channel, or logged out.
+        user = self.get_user(params.get("userid"))
+        if user:
+            self.intercept_channel(user)
+        else:
+            self.intercepted.discard(params.get("userid"))
 
-    def send_ai_response(self, chat_id, user, message_type, message):
+    def send_ai_response(self, chat_id, username, message_type, message, channel=None):
         # Getting and sending AI responses has put in a separate function which ables us to call it via thread and thus The bot can respond to multiple user at once.
         response = ''
-        if self.chats[chat_id] == "chatgpt":
-            response = self.ask_chatgpt(chat_id, message, max_tokens=200, model="gpt-4o-mini")
-        elif self.chats[chat_id] == "groq":
-            response = self.ask_groq(chat_id, message, max_tokens=200)
+        # In streaming mode every part of the answer is sent as soon as the AI has written it, instead of waiting for the whole answer.
+        chunker, on_text = None, None
+        if self.settings.get("stream_responses", True):
+            chunker = StreamChunker(self.settings.get("message_bytes", 500))
+            streamed = []
+            def on_text(text):
+                streamed.append(text)
+                for chunk in chunker.feed(text):
+                    self.send_response(message_type, username, chunk, channel)
+        # self.chats holds the name of the provider the chat has chosen, ask_ai finds it in the provider registry.
+        response = self.ask_ai(self.chats[chat_id], chat_id, message, max_tokens=200, on_text=on_text)
         print(f'AI Response: "{response}"')
-        for text in self.split_long_text(response):
-            self.send_response(message_type, user, text)
+        if chunker:
+            texts = list(chunker.flush())
+            # The answer is complete when it matches what was streamed, otherwise the stream broke and the response is the error message.
+            if response and response != "".join(streamed).strip():
+                texts += self.split_long_text(response)
+        else:
+            texts = self.split_long_text(response)
+        for text in texts:
+            self.send_response(message_type, username, text, channel)
 
     def on_message_deliver(self, server, params):
         # This function receives messages and decides what to do based on the content.
@@ -145,27 +363,47 @@ class Bot(teamtalk.TeamTalkServer):
         username = user["username"]
         nickname = user["nickname"]
         chat_id = ""
+        chanid = None
+        channel = None
         if message_type == teamtalk.USER_MSG:
             print(f'private message from "{nickname}" with username "{username}":\n"{message}"')
-            chat_id = f'user:{username}'
+            chat_id = f'user:{self.chat_prefix}{username}'
         elif message_type == teamtalk.CHANNEL_MSG:
             if not message.startswith('/'):
                 return
             print(f'channel message from "{nickname}" with username "{username}":\n"{message}"')
             chanid = params["chanid"]
-            chat_id = f'channel:{chanid}'
+            # Intercepted from a channel the bot doesn't serve, because the user has just moved there.
+            if chanid not in self.served_channels():
+                return
+            # The chat and the answers go by the path of the channel, which unlike its chanid stays the same when the bot or the server restarts.
+            channel = self.get_channel(chanid)["channel"]
+            chat_id = f'channel:{self.chat_prefix}{channel}'
         # First checking if the user wants a help for using the bot.
         if not message or message.lower() == "h":
-            self.send_response(message_type, user, self.get_help())
+            self.send_response(message_type, username, self.get_help(), channel)
             return
         # Adding this condition to avoid answering the bot messages itself.
         elif username == self.me['username']:
             return
-        # Add a condition to avoid answering users outside the channel that bot joined
-        if (self.me.get("chanid") != user.get("chanid")):
-            self.send_response(message_type, user, "افسوس! شما نمیتوانید خارج از کانال به ربات پیام بدهید!")
+        # The metrics are for admins only, and only in private, but they can ask from any channel.
+        if message_type == teamtalk.USER_MSG and username in self.settings.get("admins", []):
+            command = message.lower().split()
+            if command == ["metrics"]:
+                self.send_lines(user, metrics.registry.summary() or "no metrics yet")
+                return
+            # "profile [seconds] [sample]": cProfile the subscribers, or with sample, every thread of the bot
+            if command and command[0] == "profile":
+                seconds = min(int(command[1]), 300) if len(command) > 1 and command[1].isdigit() else 10
+                Thread(target=self.run_profile, args=(user, seconds, "sample" in command), daemon=True).start()
+                self.user_message(user, f"profiling for {seconds} seconds...")
+                return
+        # Add a condition to avoid answering users outside the channels that bot serves
+        if user.get("chanid") not in self.served_channels():
+            self.send_response(message_type, username, "افسوس! شما نمیتوانید خارج از کانال به ربات پیام بدهید!", channel)
             return
-        # Creat a chat_id to save the users and channels and which AI they choosed to talk in self.chats dictionary
+        # Commands in a channel start with "/", which isn't part of the command.
+        if message_type == teamtalk.CHANNEL_MSG:
             message = message.lstrip('/')
         # Adding bot options menu to select and remove AI to chat.
         # Add Persian numbers to get numbers in different forms.
@@ -199,13 +437,34 @@ class Bot(teamtalk.TeamTalkServer):
                 response = "شما هیچ گفتگویی  با Groq نداشتید."
         # If the user does not send the help command or menu number and has started a chat with ai, I send the message to the respected ai.
         elif chat_id in self.chats:
-            Thread(target=self.send_ai_response, args=(chat_id, user, message_type, message), daemon=True).start()
+            if not self.ai_workers.submit(chat_id, self.send_ai_response, chat_id, username, message_type, message, channel):
+                # Too many questions are waiting already, so we tell the user instead of letting the queue grow forever.
+                response = "ربات در حال حاضر سرش شلوغ است. لطفا کمی بعد دوباره بپرسید."
         # If user does not send any above command and hasn't started a chat, I will send the help message to introduce him/her to the bot options.
         else:
             response = self.get_help()
         # Finally i send the bot response.
         for text in self.split_long_text(response):
-            self.send_response(message_type, user, text)
+            self.send_response(message_type, username, text, channel)
+
+    def run_profile(self, user, seconds, sample=False):
+        # The whole report is saved next to the settings, the admin gets its first lines.
+        report = sample_threads(seconds) if sample else self.dispatch_profiler.profile(seconds)
+        path = Path.home() / f'.tt-ai-bot-profile-{time.strftime("%Y%m%d-%H%M%S")}.txt'
+        path.write_text(report)
+        print(f"profile saved to {path}")
+        lines = [line for line in report.splitlines() if line.strip()]
+        self.send_lines(user, "\n".join([str(path)] + lines[:15]))
+
+    def send_lines(self, user, content):
+        # Pack whole lines into as few private messages as possible, a line is never cut in the middle unless it is too long by itself.
+        text = ""
+        for line in content.splitlines():
+            if text and len(text) + len(line) + 1 > 250:
+                self.user_message(user, text)
+                text = ""
+            text = f"{text}\n{line}" if text else line[:250]
+        self.user_message(user, text)
 
     def get_help(self):
         # Creating a help string for introducing the bot menu to the user.
@@ -0,0 +1,146 @@
+# Cuts text into chunks that fit in a TeamTalk message, all at once (split_text) or as it arrives piece by piece,
+# like a streamed AI answer (StreamChunker). The limit is on UTF-8 bytes, not characters, because that is what goes over the wire:
+# a Persian letter takes two bytes, an emoji four.
+# Chunks keep the newlines of the text, so paragraphs, lists and code survive. A chunk ends, in order of preference, after a line,
+# after a sentence, after a word, or if a single word is too long, wherever a grapheme cluster ends.
+# Each character is looked at a bounded number of times, so the work grows linearly with the text.
+
+
+import re
+import unicodedata
+
+
+# The end of a sentence: its punctuation (Persian question mark included) plus any closing quotes or brackets, followed by a space.
+SENTENCE_END = re.compile(r'[.!?؟…]+["\'»)\]]*(?=\s)')
+
+ZWJ = "\u200d"
+# characters that belong to the grapheme cluster before them, besides the combining marks: the zero width joiner and non-joiner
+# (the Persian half space), the variation selectors that choose text or emoji style, and the emoji skin tones
+EXTENDERS = {ZWJ, "\u200c", "\ufe0e", "\ufe0f"} | {chr(code) for code in range(0x1f3fb, 0x1f400)}
+
+
+def _is_regional_indicator(char):
+    return "\U0001f1e6" <= char <= "\U0001f1ff"
+
+
+def _joins(text, index):
+    # True if text[index] is part of the grapheme cluster of text[index - 1], so the text can't be cut between them.
+    char, previous = text[index], text[index - 1]
+    if char in EXTENDERS or previous == ZWJ or (previous == "\r" and char == "\n"):
+        return True
+    if unicodedata.category(char) in ("Mn", "Mc", "Me"):
+        return True
+    if _is_regional_indicator(char) and _is_regional_indicator(previous):
+        # a flag is a pair of regional indicators, so they join when an odd number of them comes before
+        count = 1
+        while index - count - 1 >= 0 and _is_regional_indicator(text[index - count - 1]):
+            count += 1
+        return count % 2 == 1
+    return False
+
+
+def _fit(text, start, max_bytes):
+    # The end of the longest text[start:end] that takes at most max_bytes in UTF-8.
+    # No character takes less than a byte, so looking at max_bytes characters is always enough.
+    window = text[start:start + max_bytes]
+    encoded = window.encode("utf-8", "surrogatepass")
+    if len(encoded) <= max_bytes:
+        return start + len(window)
+    return start + len(encoded[:max_bytes].decode("utf-8", "ignore"))
+
+
+def _sentence_end(text, start, end):
+    # The end of the last sentence in text[start:end], or -1. The search goes one character further to see the space after it.
+    last = -1
+    for match in SENTENCE_END.finditer(text, start, end + 1):
+        if match.end() <= end:
+            last = match.end()
+    return last
+
+
+def _break(text, start, end):
+    # Where to end a chunk that starts at start and can't go past end.
+    # Lines and sentences only count in the second half, so that a short first line doesn't make a short chunk.
+    middle = start + (end - start) // 2
+    newline = text.rfind("\n", middle, end)
+    if newline != -1:
+        return newline + 1
+    sentence = _sentence_end(text, middle, end)
+    if sentence != -1:
+        return sentence
+    space = text.rfind(" ", start + 1, end)
+    if space != -1:
+        return space + 1
+    while end - 1 > start and _joins(text, end):
+        end -= 1
+    return end
+
+
+def _clean(chunk, line_start):
+    # Drops the blank lines and spaces around the cut, but not the indentation of a chunk that starts a line.
+    chunk = chunk.rstrip()
+    if not line_start:
+        chunk = chunk.lstrip(" \t")
+    return chunk.lstrip("\r\n")
+
+
+def split_text(text, max_bytes=500):
+    # Yields the chunks of a whole text, each at most max_bytes in UTF-8.
+    start = 0
+    while start < len(text):
+        end = _fit(text, start, max_bytes)
+        if end < len(text):
+            end = _break(text, start, end)
+        chunk = _clean(text[start:end], start == 0 or text[start - 1] == "\n")
+        if chunk:
+            yield chunk
+        start = end
+
+
+class StreamChunker:
+    def __init__(self, max_bytes=500, min_bytes=160):
+        # Chunks are never longer than max_bytes in UTF-8.
+        # Once min_bytes are buffered, the text up to the last finished line or sentence is sent without waiting for more.
+        self.max_bytes = max_bytes
+        self.min_bytes = min_bytes
+        self._buffer = ""
+        self._bytes = 0
+        self._line_start = True
+
+    def feed(self, text):
+        # Adds text and returns a generator of the chunks it completed, which may be none.
+        self._buffer += text
+        self._bytes += len(text.encode("utf-8", "surrogatepass"))
+        return self._chunks(final=False)
+
+    def flush(self):
+        # Returns a generator of whatever is still buffered, as the last chunks.
+        return self._chunks(final=True)
+
+    def _chunks(self, final):
+        while self._buffer:
+            end = self._next_end(final)
+            if end is None:
+                return
+            chunk = _clean(self._buffer[:end], self._line_start)
+            self._line_start = self._buffer[end - 1] == "\n"
+            self._buffer = self._buffer[end:]
+            self._bytes = len(self._buffer.encode("utf-8", "surrogatepass"))
+            if chunk:
+                yield chunk
+
+    def _next_end(self, final):
+        # Where the next complete chunk ends in the buffer, or None if it isn't complete yet.
+        # The buffer holds little more than max_bytes, so each search costs at most about a chunk's worth of work.
+        buffer = self._buffer
+        if self._bytes > self.max_bytes:
+            return _break(buffer, 0, _fit(buffer, 0, self.max_bytes))
+        if final:
+            return len(buffer)
+        if self._bytes < self.min_bytes:
+            return None
+        newline = buffer.rfind("\n")
+        if newline != -1:
+            return newline + 1
+        sentence = _sentence_end(buffer, 0, len(buffer))
+        return sentence if sentence != -1 else None
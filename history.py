@@ -0,0 +1,69 @@
+# The conversation history of one chat, limited by an estimate of its size in tokens instead of a number of messages.
+# Every message is stored with its token count, so keeping the total up to date costs nothing,
+# and the oldest messages are dropped from the front of a deque as soon as the budget is exceeded.
+
+
+from itertools import islice
+from collections import deque
+
+
+def estimate_tokens(text):
+    # A rough estimate that needs no tokenizer: about 4 bytes of UTF-8 per token, which holds reasonably well for English and Persian alike.
+    # Every message also costs a few tokens for its role and separators.
+    return len(text.encode("utf-8")) // 4 + 4
+
+
+class ChatHistory:
+    def __init__(self, max_tokens=3000, system_prompt="", count_tokens=estimate_tokens):
+        self.max_tokens = max_tokens
+        self.count_tokens = count_tokens
+        # (message, tokens) pairs, oldest first
+        self._messages = deque()
+        self._system = None
+        self.tokens = 0
+        # called with (role, content) for every appended message, used to save it elsewhere
+        self.on_append = None
+        self.set_system_prompt(system_prompt)
+
+    def __len__(self):
+        return len(self._messages)
+
+    def set_system_prompt(self, prompt):
+        # The system prompt is pinned: it is always sent first and never trimmed, but it counts against the budget.
+        if self._system:
+            self.tokens -= self._system[1]
+        self._system = None
+        if prompt:
+            self._system = ({"role": "system", "content": prompt}, self.count_tokens(prompt))
+            self.tokens += self._system[1]
+        self._trim()
+
+    def append(self, role, content):
+        tokens = self.count_tokens(content)
+        self._messages.append(({"role": role, "content": content}, tokens))
+        self.tokens += tokens
+        self._trim()
+        if self.on_append:
+            self.on_append(role, content)
+
+    def clear(self):
+        self._messages.clear()
+        self.tokens = self._system[1] if self._system else 0
+
+    def messages(self):
+        # The list of messages to send to the AI, system prompt first.
+        messages = [self._system[0]] if self._system else []
+        messages.extend(message for message, tokens in self._messages)
+        return messages
+
+    def tail(self, count):
+        # The newest count messages, oldest first.
+        messages = [message for message, tokens in islice(reversed(self._messages), count)]
+        messages.reverse()
+        return messages
+
+    def _trim(self):
+        # Drop the oldest messages until the history fits, but always keep the newest one so the question itself is never lost.
+        while self.tokens > self.max_tokens and len(self._messages) > 1:
+            message, tokens = self._messages.popleft()
+            self.tokens -= tokens
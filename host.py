@@ -0,0 +1,132 @@
+# Runs the bot on several TeamTalk servers, or with several accounts on one server, in one process.
+# The servers are listed in the servers setting, each one a dictionary with any of host, port, username, password, nickname, channel and channel_password,
+# plus a name that must stay the same between runs because the chats of the server are saved under it. What a server leaves out is taken from the main settings.
+# All connections are read and written by one asyncio event loop, instead of three threads per connection,
+# and they share one set of AI clients, conversation histories, AI workers and conversation store.
+# usage: python host.py run
+
+
+import re
+import asyncio
+import inspect
+import teamtalk
+from threading import Thread
+from bot import bot, Bot
+from ai import chatgpt_user_messages, groq_user_messages
+from ai import ask, warm_up
+
+
+class HostedBot(Bot, teamtalk.AsyncTeamTalkServer):
+    # Everything that isn't about the connection itself is shared with the bot that was created from the settings.
+    shared = ("settings_dir", "store", "chats", "ai_workers", "slow_handlers", "dispatch_profiler", "ask_ai", "chatgpt_user_messages", "groq_user_messages")
+
+    def __init__(self, main_bot, name, settings):
+        teamtalk.AsyncTeamTalkServer.__init__(self)
+        for attribute in self.shared:
+            setattr(self, attribute, getattr(main_bot, attribute))
+        self.name = name
+        self.settings = dict(main_bot.settings, **settings)
+        self.chat_prefix = f"{name}/"
+        self.metrics_prefix = "teamtalk_" + re.sub(r"\W", "_", name)
+        self.loop = None
+        self.configure_server()
+
+    async def start_bot(self):
+        # Bot.supervise on the event loop: stays connected for as long as the host runs, connecting again whenever the connection drops.
+        self.loop = asyncio.get_running_loop()
+        # set by restart_bot, on the loop
+        self.reconnect_now = asyncio.Event()
+        failures = 0
+        while True:
+            try:
+                await self.connect_bot()
+                failures = 0
+                print(f"{self.name}: connected")
+                await self.handle_messages(1)
+            except Exception as error:
+                failures += 1
+                print(f"{self.name}: connecting failed: {error!r}")
+            self.connection_closed()
+            if self.writer:
+                await self.disconnect()
+            delay = self.reconnect_delay(failures)
+            print(f"{self.name}: connecting again in {delay:.1f} seconds")
+            try:
+                await asyncio.wait_for(self.reconnect_now.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+            self.reconnect_now.clear()
+            self.reset()
+
+    async def connect_bot(self):
+        self.set_connection_info(self.settings["host"], int(self.settings["port"]))
+        await self.connect()
+        await self.login(self.settings["nickname"], self.settings["username"], self.settings["password"], "tt_bot")
+        self.check_login()
+        self.migrate_channel_chats()
+        if self.settings["channel"]:
+            await self.join(self.settings["channel"], self.settings["channel_password"])
+        self.flush_outbox()
+
+    def restart_bot(self):
+        # Bot.restart_bot, for the event loop: disconnect is a coroutine there, and start_bot waits on an asyncio event. Safe to call from any thread.
+        def restart():
+            self.reconnect_now.set()
+            if self.writer and not self.disconnecting:
+                self._create_task(self.disconnect())
+        self.loop.call_soon_threadsafe(restart)
+
+    def call_in_loop(self, func, *args):
+        # The messages of the bot are also sent from the AI worker threads, while the connection belongs to the event loop.
+        # So func runs on the loop, in the order of the calls, and the coroutine it returns is scheduled there.
+        def run():
+            result = func(*args)
+            if inspect.isawaitable(result):
+                self._create_task(result)
+        self.loop.call_soon_threadsafe(run)
+        return True
+
+    def user_message(self, to, content, id=None):
+        return self.call_in_loop(super().user_message, to, content, id)
+
+    def channel_message(self, content, to=None, id=None):
+        return self.call_in_loop(super().channel_message, content, to, id)
+
+    def subscribe_to(self, user, subscription, id=None, priority=teamtalk.PRIORITY_CONTROL):
+        return self.call_in_loop(super().subscribe_to, user, subscription, id, priority)
+
+    def unsubscribe_from(self, user, subscription, id=None, priority=teamtalk.PRIORITY_CONTROL):
+        return self.call_in_loop(super().unsubscribe_from, user, subscription, id, priority)
+
+
+class BotHost:
+    def __init__(self, main_bot):
+        self.bot = main_bot
+        servers = main_bot.settings.get("servers") or [{}]
+        self.connections = []
+        for settings in servers:
+            name = settings.get("name") or "{host}:{port}:{username}".format(**dict(main_bot.settings, **settings))
+            self.connections.append(HostedBot(main_bot, name, settings))
+
+    async def serve(self, connection):
+        # A connection that fails in a way start_bot can't recover from doesn't stop the others.
+        try:
+            await connection.start_bot()
+        except Exception as error:
+            print(f"{connection.name}: {error!r}")
+
+    async def run(self):
+        await asyncio.gather(*(self.serve(connection) for connection in self.connections))
+
+
+if __name__ == "__main__":
+    bot.chatgpt_user_messages, bot.groq_user_messages = chatgpt_user_messages, groq_user_messages
+    bot.ask_ai = ask
+    host = BotHost(bot)
+    print(f"serving {len(host.connections)} server(s): {', '.join(connection.name for connection in host.connections)}")
+    if bot.settings.get("ai_warm_up", True):
+        Thread(target=warm_up, daemon=True).start()
+    try:
+        asyncio.run(host.run())
+    except KeyboardInterrupt:
+        print('Exiting ...')
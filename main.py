@@ -5,16 +5,17 @@
 
 import os
 import platform
+from threading import Thread
 from bot import bot
 from ai import chatgpt_user_messages, deepseek_user_messages, groq_user_messages
-from ai import ask_chatgpt, ask_deepseek, ask_groq
+from ai import ask, warm_up
 
 
 if __name__ == "__main__":
     # Adding the ai functions and dictionaries to the bot object.
     # Because of circular import error, I can not import the ai functions and objects in bot.py directly.
     bot.chatgpt_user_messages, bot.groq_user_messages = chatgpt_user_messages, groq_user_messages
-    bot.ask_chatgpt, bot.ask_groq = ask_chatgpt, ask_groq
+    bot.ask_ai = ask
     # clear the screen from settings in console for security reasons.
     if platform.platform().startswith('Linux'):
         os.system('clear')
@@ -22,6 +23,9 @@ if __name__ == "__main__":
         os.system('cls')
     # Start the bot.
     bot.start_bot()
+    # Connect to the AI providers in the background, so the first question doesn't pay for opening the connections.
+    if bot.settings.get("ai_warm_up", True):
+        Thread(target=warm_up, daemon=True).start()
     # adding a loop which ables us to restart the bot more easyly.
     while True:
         try:
@@ -0,0 +1,224 @@
+# Counters, gauges and histograms about what the bot is doing, kept in memory.
+# They can be read as text in the Prometheus format from a local HTTP endpoint (the metrics_port setting),
+# or as a short summary by the admins of the bot, who send it "metrics" in a private message.
+# Every metric can carry labels, each combination of label values is a separate series.
+
+
+import threading
+from bisect import bisect_left
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+# upper bounds in seconds, from a quick dispatch to a slow AI answer
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{str(value)}"'.replace("\n", " ") for name, value in pairs) + "}"
+
+
+class Metric:
+    type = ""
+
+    def __init__(self, name, help="", func=None):
+        self.name = name
+        self.help = help
+        # a metric with a func has no series of its own, its only value is whatever func returns when it is read
+        self.func = func
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def value(self, **labels):
+        if self.func:
+            return self.func()
+        return self._values.get(_label_key(labels), 0)
+
+    def series(self):
+        # (label key, value) pairs
+        if self.func:
+            return [((), self.func())]
+        with self._lock:
+            return list(self._values.items())
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        for key, value in self.series():
+            lines.append(f"{self.name}{_format_labels(key)} {value}")
+        return lines
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[_label_key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, help="", buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                # a count per bucket plus one for everything above the last, then the sum
+                series = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][bisect_left(self.buckets, value)] += 1
+            series[1] += value
+
+    def count(self, **labels):
+        series = self._values.get(_label_key(labels))
+        return sum(series[0]) if series else 0
+
+    def quantile(self, quantile, **labels):
+        # The upper bound of the bucket the quantile falls in, so it is never lower than the real value.
+        with self._lock:
+            series = self._values.get(_label_key(labels))
+            counts = list(series[0]) if series else []
+        return self._quantile(counts, quantile)
+
+    def _quantile(self, counts, quantile):
+        total = sum(counts)
+        if not total:
+            return None
+        rank = quantile * total
+        seen = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def series(self):
+        with self._lock:
+            return [(key, (list(counts), total)) for key, (counts, total) in self._values.items()]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        for key, (counts, total) in self.series():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(key, [('le', bound)])} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+        self._server = None
+
+    def _get(self, cls, name, *args, **kwargs):
+        # Returns the metric called name, creating it on first use. Asking again for the same name returns the same metric,
+        # and a new func replaces the old one, so a reconnected server can point its metrics at its new state.
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, *args, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError(f"{name} is already a {metric.type}")
+            elif kwargs.get("func"):
+                metric.func = kwargs["func"]
+            return metric
+
+    def counter(self, name, help="", func=None):
+        return self._get(Counter, name, help, func=func)
+
+    def gauge(self, name, help="", func=None):
+        return self._get(Gauge, name, help, func=func)
+
+    def histogram(self, name, help="", buckets=DEFAULT_BUCKETS):
+        return self._get(Histogram, name, help, buckets=buckets)
+
+    def render(self):
+        # Every metric in the Prometheus text format.
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        # A short version for a chat message: one line per series, histograms as count, average, p50 and p95.
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            for key, value in metric.series():
+                name = metric.name + _format_labels(key)
+                if isinstance(metric, Histogram):
+                    counts, total = value
+                    count = sum(counts)
+                    if count:
+                        lines.append(f"{name} count={count} avg={total / count:.3f} p50<={metric._quantile(counts, 0.5)} p95<={metric._quantile(counts, 0.95)}")
+                elif value:
+                    lines.append(f"{name} {round(value, 3)}")
+        return "\n".join(lines)
+
+    def serve(self, port, host="127.0.0.1"):
+        # Serves render() at http://host:port/metrics from a background thread. Only listens on localhost unless told otherwise.
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.rstrip("/") not in ("", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name="metrics-http", daemon=True).start()
+        return self._server.server_address[1]
+
+    def close(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+# the registry every module of the bot records into
+registry = MetricsRegistry()
@@ -0,0 +1,119 @@
+# Tools to find out what makes the bot slow while it is running.
+# SlowHandlerLog and DispatchProfiler are TeamTalkServer middleware: they wrap every subscriber call on the thread reading from the server,
+# where one slow subscriber delays every line behind it. sample_threads looks at every thread of the process instead, the AI workers included.
+
+
+import io
+import sys
+import time
+import pstats
+import cProfile
+import threading
+import traceback
+from collections import Counter
+
+
+def _subscriber_name(func):
+    return getattr(func, "__qualname__", repr(func))
+
+
+class SlowHandlerLog:
+    def __init__(self, threshold=0.2, log=print, max_params=300):
+        # Every subscriber call that takes threshold seconds or more is passed to log with its event and params, cut to max_params characters.
+        self.threshold = threshold
+        self.log = log
+        self.max_params = max_params
+        self.slow_calls = 0
+
+    def __call__(self, server, event, func, params, call):
+        start = time.perf_counter()
+        try:
+            return call()
+        finally:
+            elapsed = time.perf_counter() - start
+            if elapsed >= self.threshold:
+                self.slow_calls += 1
+                text = repr(params)
+                if len(text) > self.max_params:
+                    text = text[:self.max_params] + "..."
+                self.log(f"slow subscriber {_subscriber_name(func)} took {elapsed:.3f}s for {event}: {text}")
+
+
+class DispatchProfiler:
+    # Runs the subscribers under cProfile while a profiling window is open, and calls them directly the rest of the time.
+    def __init__(self):
+        self._profile = None
+        self._until = 0
+        self._lock = threading.Lock()
+
+    @property
+    def running(self):
+        return self._profile is not None
+
+    def start(self, seconds):
+        # Returns False if a window is open already.
+        with self._lock:
+            if self._profile is not None:
+                return False
+            self._profile = cProfile.Profile()
+            self._until = time.monotonic() + seconds
+            return True
+
+    def stop(self, top=20, sort="cumulative"):
+        # Closes the window and returns the top functions of the report as text.
+        with self._lock:
+            profile, self._profile = self._profile, None
+        if profile is None:
+            return ""
+        output = io.StringIO()
+        try:
+            pstats.Stats(profile, stream=output).sort_stats(sort).print_stats(top)
+        except TypeError:
+            # nothing was called while the window was open
+            return "no subscriber was called"
+        return output.getvalue()
+
+    def profile(self, seconds, top=20, sort="cumulative"):
+        # Profiles the subscribers for seconds and returns the report. Blocks, so run it on its own thread.
+        if not self.start(seconds):
+            return "a profile is running already"
+        time.sleep(seconds)
+        return self.stop(top, sort)
+
+    def __call__(self, server, event, func, params, call):
+        profile = self._profile
+        if profile is None or time.monotonic() > self._until:
+            return call()
+        return profile.runcall(call)
+
+
+def sample_threads(seconds, interval=0.005, top=20):
+    # A sampling profiler over every thread: every interval seconds the stack of each thread is recorded.
+    # Returns the functions found most often at the top of a stack (where the time is spent)
+    # and anywhere in a stack (what the time is spent for), as text.
+    me = threading.get_ident()
+    names = {thread.ident: thread.name for thread in threading.enumerate()}
+    own = Counter()
+    total = Counter()
+    threads = Counter()
+    samples = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            stack = traceback.extract_stack(frame)
+            if not stack:
+                continue
+            top_frame = stack[-1]
+            own[f"{top_frame.name} ({top_frame.filename}:{top_frame.lineno})"] += 1
+            for function in {f"{entry.name} ({entry.filename})" for entry in stack}:
+                total[function] += 1
+            threads[names.get(ident, ident)] += 1
+        samples += 1
+        time.sleep(interval)
+    lines = [f"{samples} samples of {len(threads)} threads over {seconds}s", "", "most often running:"]
+    lines += [f"{count:6} {function}" for function, count in own.most_common(top)]
+    lines += ["", "most often on the stack:"]
+    lines += [f"{count:6} {function}" for function, count in total.most_common(top)]
+    return "\n".join(lines)
@@ -0,0 +1,396 @@
+# The AI providers the bot can talk to, behind one interface, and a registry to find them by name.
+# A question can be hedged: if the chosen provider hasn't started answering by its usual 95th percentile latency,
+# the same messages are sent to a fallback provider too, the first one to answer is used and the other one is aborted.
+# Failed requests are retried with a jittered exponential backoff, and a circuit breaker stops sending requests
+# to a provider that keeps failing until a health probe shows it is back.
+
+
+import time
+import random
+import threading
+from collections import deque
+from concurrent.futures import Future, wait, FIRST_COMPLETED
+from metrics import registry
+
+
+requests_in_flight = registry.gauge("ai_requests_in_flight", "Requests to AI providers waiting for or reading an answer, by provider")
+request_seconds = registry.histogram("ai_request_seconds", "Duration of requests to AI providers, by provider and outcome")
+first_text_seconds = registry.histogram("ai_first_text_seconds", "Time from sending a request to the first text of the answer, by provider")
+errors_total = registry.counter("ai_errors_total", "Failed requests to AI providers, by provider and HTTP status or error type")
+retries_total = registry.counter("ai_retries_total", "Requests sent again after a retryable error, by provider")
+
+
+class Cancelled(Exception):
+    # Raised inside a request that lost the race, to stop reading its answer.
+    pass
+
+
+class Abort:
+    # Stops a request from another thread by closing the response it is reading, which makes the read fail right away.
+    # complete registers every response it reads from, one that comes after abort() is closed at once.
+    def __init__(self):
+        self.aborted = False
+        self._response = None
+        self._lock = threading.Lock()
+
+    def register(self, response):
+        # response is anything with a close method. Raises Cancelled if the request has been aborted already.
+        with self._lock:
+            if not self.aborted:
+                self._response = response
+                return response
+        response.close()
+        raise Cancelled()
+
+    def abort(self):
+        with self._lock:
+            self.aborted = True
+            response, self._response = self._response, None
+        if response is not None:
+            try:
+                response.close()
+            except Exception:
+                pass
+
+
+class CircuitOpen(Exception):
+    # Raised instead of sending a request to a provider whose circuit breaker is open.
+    def __init__(self, provider):
+        super().__init__(f"{provider.name} is failing, requests are paused until it recovers")
+        self.provider = provider
+
+
+class CircuitBreaker:
+    # Opens after max_failures failed requests in a row. While it is open no request is sent,
+    # but every reset_timeout seconds one health probe may run, and the breaker closes again as soon as a probe succeeds.
+    def __init__(self, max_failures=5, reset_timeout=30):
+        self.max_failures = max_failures
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trips = 0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.max_failures and self.opened_at is None:
+                self.opened_at = time.monotonic()
+                self.trips += 1
+
+    def should_probe(self):
+        # True for the one caller that should run the next probe.
+        with self._lock:
+            if self.opened_at is None or self._probing or time.monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            self._probing = True
+            return True
+
+    def probe_done(self, succeeded):
+        with self._lock:
+            self._probing = False
+            if not succeeded:
+                self.opened_at = time.monotonic()
+        if succeeded:
+            self.success()
+
+
+class LatencyTracker:
+    # The latencies of the last window requests of a provider, from sending the request to the first text of the answer.
+    def __init__(self, window=200, min_samples=20):
+        self.min_samples = min_samples
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._samples)
+
+    def add(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, percent):
+        # Returns None until there are enough samples for the number to mean something.
+        with self._lock:
+            if len(self._samples) < self.min_samples:
+                return None
+            samples = sorted(self._samples)
+        return samples[min(len(samples) - 1, int(len(samples) * percent / 100))]
+
+
+class Provider:
+    # Subclasses set name, title and model, and implement complete.
+    name = ""
+    # how the provider is called in messages to the users
+    title = ""
+    model = ""
+
+    def __init__(self, api_key, model=None, histories=None, connect_timeout=5, read_timeout=60, retries=2):
+        self.api_key = api_key
+        if model:
+            self.model = model
+        # the ChatHistories of the chats talking to this provider
+        self.histories = histories
+        # seconds to wait for the connection, and for every read from it, so a request can never hang forever
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        # how many times a request that failed with a retryable error is sent again, waiting up to retry_delay * 2 ** attempt seconds in between
+        self.retries = retries
+        self.retry_delay = 0.5
+        self.max_retry_delay = 8
+        self.latency = LatencyTracker()
+        self.breaker = CircuitBreaker()
+
+    def available(self):
+        return bool(self.api_key)
+
+    def complete(self, messages, model, max_tokens, on_text=None, abort=None):
+        # Returns the answer to messages. When on_text is given the answer is streamed, and every piece is passed to on_text as it arrives.
+        # When abort is given, the streamed response is registered with it before anything is read.
+        # Errors are raised, error_message turns them into text for the user.
+        raise NotImplementedError
+
+    def is_retryable(self, error):
+        # Rate limits, server errors, timeouts and lost connections are worth another try, and count against the circuit breaker.
+        return isinstance(error, (ConnectionError, TimeoutError))
+
+    def probe(self):
+        # A cheap request that raises if the provider is still failing.
+        self.complete([{"role": "user", "content": "ping"}], self.model, 1)
+
+    def request(self, messages, model, max_tokens, on_text=None, abort=None):
+        # complete, with retries and the circuit breaker. A request is never retried once a part of the answer was passed to on_text.
+        # Once abort is aborted the request raises Cancelled, whatever error closing its response caused.
+        streamed = False
+
+        def on_streamed_text(text):
+            nonlocal streamed
+            streamed = True
+            on_text(text)
+
+        attempt = 0
+        while True:
+            if abort is not None and abort.aborted:
+                raise Cancelled()
+            if self.breaker.is_open:
+                self.start_probe()
+                errors_total.inc(provider=self.name, error="circuit_open")
+                raise CircuitOpen(self)
+            requests_in_flight.inc(provider=self.name)
+            start = time.monotonic()
+            try:
+                answer = self.complete(messages, model, max_tokens, on_streamed_text if on_text else None, abort)
+            except Cancelled:
+                request_seconds.observe(time.monotonic() - start, provider=self.name, outcome="cancelled")
+                raise
+            except Exception as e:
+                if abort is not None and abort.aborted:
+                    request_seconds.observe(time.monotonic() - start, provider=self.name, outcome="cancelled")
+                    raise Cancelled() from e
+                request_seconds.observe(time.monotonic() - start, provider=self.name, outcome="error")
+                errors_total.inc(provider=self.name, error=self.error_code(e))
+                if not self.is_retryable(e):
+                    raise
+                self.breaker.failure()
+                if streamed or attempt >= self.retries:
+                    raise
+                delay = random.uniform(0, min(self.max_retry_delay, self.retry_delay * 2 ** attempt))
+                time.sleep(delay)
+                attempt += 1
+                retries_total.inc(provider=self.name)
+                continue
+            finally:
+                requests_in_flight.dec(provider=self.name)
+            request_seconds.observe(time.monotonic() - start, provider=self.name, outcome="ok")
+            self.breaker.success()
+            return answer
+
+    @staticmethod
+    def error_code(error):
+        # the HTTP status of a failed request if there was one, else the name of the error
+        status = getattr(error, "status_code", None) or getattr(getattr(error, "response", None), "status_code", None)
+        return str(status) if status else type(error).__name__
+
+    def start_probe(self):
+        if self.breaker.should_probe():
+            threading.Thread(target=self._run_probe, name=f"{self.name}-probe", daemon=True).start()
+
+    def _run_probe(self):
+        try:
+            self.probe()
+        except Exception:
+            self.breaker.probe_done(False)
+        else:
+            self.breaker.probe_done(True)
+
+    def error_message(self, error):
+        if isinstance(error, CircuitOpen):
+            return f"{self.title} در حال حاضر در دسترس نیست. لطفا کمی بعد دوباره بپرسید."
+        return f"خطای ناشناخته: {error}"
+
+    def empty_message(self):
+        return f"مشکلی در دریافت پاسخ از {self.title} به وجود آمد!"
+
+
+_providers = {}
+
+
+def register(provider):
+    _providers[provider.name] = provider
+    return provider
+
+
+def get_provider(name):
+    return _providers[name]
+
+
+def get_providers():
+    return list(_providers.values())
+
+
+class _Race:
+    # The requests sent for one question. The first of them to pass text to its on_text wins, and the others are aborted.
+    def __init__(self, on_text):
+        self.on_text = on_text
+        self.winner = None
+        # set to the winner as soon as there is one
+        self.first = Future()
+        # provider -> (start, Abort) of the requests still running
+        self._running = {}
+        self._lock = threading.Lock()
+
+    def attempt(self, provider, messages, model, max_tokens):
+        start = time.monotonic()
+        abort = Abort()
+        with self._lock:
+            if self.winner is not None:
+                # decided before this request was sent
+                raise Cancelled()
+            self._running[provider] = (start, abort)
+
+        def on_text(text):
+            if self.winner is None:
+                self._win(provider, start)
+            if self.winner is not provider:
+                raise Cancelled()
+            if self.on_text:
+                self.on_text(text)
+
+        try:
+            answer = provider.request(messages, model, max_tokens, on_text, abort)
+        finally:
+            with self._lock:
+                self._running.pop(provider, None)
+        if self.winner is None:
+            # an empty answer, it still tells how fast the provider was
+            provider.latency.add(time.monotonic() - start)
+        return answer
+
+    def _win(self, provider, start):
+        with self._lock:
+            if self.winner is not None:
+                return
+            self.winner = provider
+        provider.latency.add(time.monotonic() - start)
+        first_text_seconds.observe(time.monotonic() - start, provider=provider.name)
+        self.first.set_result(provider)
+        self.stop()
+
+    def stop(self):
+        # Aborts every request that is still running and isn't the winner, so it gives back its thread and connection.
+        # Such a request hasn't passed any text yet, so it took at least as long as it ran. That is recorded as its latency,
+        # otherwise the p95 of a provider that slowed down would stay at its old value and every question would be hedged.
+        with self._lock:
+            losers = [(provider, start, abort) for provider, (start, abort) in self._running.items() if provider is not self.winner]
+            for provider, start, abort in losers:
+                del self._running[provider]
+        now = time.monotonic()
+        for provider, start, abort in losers:
+            provider.latency.add(now - start)
+            abort.abort()
+
+
+class HedgedCompleter:
+    def __init__(self, fallbacks=None):
+        # provider name -> name of the provider to hedge with
+        self.fallbacks = fallbacks or {}
+        self.hedge_percentile = 95
+        self.hedged = 0
+        self.hedges_won = 0
+        self.rerouted = 0
+
+    def fallback_for(self, provider):
+        name = self.fallbacks.get(provider.name)
+        fallback = _providers.get(name) if name else None
+        if fallback is None or fallback is provider or not fallback.available() or fallback.breaker.is_open:
+            return None
+        return fallback
+
+    def complete(self, provider, messages, model, max_tokens, on_text=None):
+        # Returns the answer of provider, or of its fallback if that one answered first.
+        # The answer is always streamed internally, that is how a request which lost the race gets cancelled.
+        race = _Race(on_text)
+        fallback = self.fallback_for(provider)
+        if provider.breaker.is_open and fallback:
+            # the chosen provider is down, its fallback answers until a probe shows it is back
+            self.rerouted += 1
+            provider.start_probe()
+            return race.attempt(fallback, messages, fallback.model, max_tokens)
+        delay = provider.latency.percentile(self.hedge_percentile) if fallback else None
+        if delay is None:
+            return race.attempt(provider, messages, model, max_tokens)
+
+        futures = {self._start(race.attempt, provider, messages, model, max_tokens): provider}
+        wait([race.first, *futures], timeout=delay, return_when=FIRST_COMPLETED)
+        if not race.first.done() and not any(future.done() for future in futures):
+            self.hedged += 1
+            futures[self._start(race.attempt, fallback, messages, fallback.model, max_tokens)] = fallback
+
+        error = None
+        pending = dict(futures)
+        try:
+            while pending:
+                wait([race.first, *pending], return_when=FIRST_COMPLETED)
+                if race.first.done():
+                    winner = race.first.result()
+                    if winner is not provider:
+                        self.hedges_won += 1
+                    return next(future for future, attempt in futures.items() if attempt is winner).result()
+                for future in [future for future in pending if future.done()]:
+                    attempt = pending.pop(future)
+                    try:
+                        # finished without passing any text: an empty answer, unless the request failed
+                        return future.result()
+                    except Exception as e:
+                        # if both requests fail, the user sees why the chosen provider failed
+                        if error is None or attempt is provider:
+                            error = e
+            raise error
+        finally:
+            # an empty answer doesn't win the race, the other request isn't needed either
+            race.stop()
+
+    @staticmethod
+    def _start(func, *args):
+        # Every request of a hedged question runs in a thread of its own. With a pool, a fallback could wait for a thread
+        # behind requests that hang without answering, which are exactly the ones it should overtake.
+        future = Future()
+
+        def run():
+            try:
+                future.set_result(func(*args))
+            except BaseException as e:
+                future.set_exception(e)
+
+        threading.Thread(target=run, name="ai-hedge", daemon=True).start()
+        return future
@@ -0,0 +1,216 @@
+# Keeps the conversations and the AI each chat has chosen in a SQLite database, so they survive restarts.
+# Every message is written as soon as it is added. A chat is read back only when it speaks again,
+# and chats that have been quiet for max_idle seconds are dropped from memory, they are still on disk.
+
+
+import time
+import sqlite3
+import threading
+from history import ChatHistory
+
+
+SCHEMA = """
+create table if not exists messages (
+    id integer primary key autoincrement,
+    provider text not null,
+    chat_id text not null,
+    role text not null,
+    content text not null
+);
+create index if not exists messages_chat on messages (provider, chat_id, id);
+create table if not exists chats (
+    chat_id text primary key,
+    provider text not null
+);
+"""
+
+
+class ConversationStore:
+    def __init__(self, path):
+        self.path = path
+        self._db = sqlite3.connect(str(path), check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._db:
+            # WAL lets us append a message without rewriting the database, and NORMAL only syncs at checkpoints.
+            self._db.execute("pragma journal_mode=wal")
+            self._db.execute("pragma synchronous=normal")
+            self._db.executescript(SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def add_message(self, provider, chat_id, role, content):
+        with self._lock, self._db:
+            self._db.execute("insert into messages (provider, chat_id, role, content) values (?, ?, ?, ?)", (provider, chat_id, role, content))
+
+    def load_messages(self, provider, chat_id, limit=200):
+        # Returns the newest limit messages of a chat as (role, content) pairs, oldest first.
+        # Older messages could never be sent again, so they are deleted on the way.
+        with self._lock, self._db:
+            rows = self._db.execute(
+                "select id, role, content from messages where provider = ? and chat_id = ? order by id desc limit ?",
+                (provider, chat_id, limit)
+            ).fetchall()
+            if len(rows) == limit:
+                self._db.execute("delete from messages where provider = ? and chat_id = ? and id < ?", (provider, chat_id, rows[-1][0]))
+        rows.reverse()
+        return [(role, content) for id, role, content in rows]
+
+    def has_messages(self, provider, chat_id):
+        with self._lock:
+            return self._db.execute("select 1 from messages where provider = ? and chat_id = ? limit 1", (provider, chat_id)).fetchone() is not None
+
+    def delete_messages(self, provider, chat_id):
+        # Returns True if there were any.
+        with self._lock, self._db:
+            return self._db.execute("delete from messages where provider = ? and chat_id = ?", (provider, chat_id)).rowcount > 0
+
+    def chat_ids(self, prefix):
+        # The chat_ids starting with prefix that have messages or a choice.
+        with self._lock:
+            rows = self._db.execute(
+                "select chat_id from messages where substr(chat_id, 1, ?) = ? union select chat_id from chats where substr(chat_id, 1, ?) = ?",
+                (len(prefix), prefix, len(prefix), prefix)
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def rename_chat(self, old, new):
+        # Moves the messages and the choice of chat old to chat new, unless new has some of its own already.
+        with self._lock, self._db:
+            if self._db.execute("select 1 from messages where chat_id = ? union select 1 from chats where chat_id = ?", (new, new)).fetchone():
+                return False
+            self._db.execute("update messages set chat_id = ? where chat_id = ?", (new, old))
+            self._db.execute("update chats set chat_id = ? where chat_id = ?", (new, old))
+        return True
+
+    def get_choice(self, chat_id):
+        with self._lock:
+            row = self._db.execute("select provider from chats where chat_id = ?", (chat_id,)).fetchone()
+        return row[0] if row else None
+
+    def set_choice(self, chat_id, provider):
+        with self._lock, self._db:
+            self._db.execute("insert or replace into chats (chat_id, provider) values (?, ?)", (chat_id, provider))
+
+    def delete_choice(self, chat_id):
+        with self._lock, self._db:
+            self._db.execute("delete from chats where chat_id = ?", (chat_id,))
+
+
+class _IdleMap:
+    # Holds values for the chats that are in use. Each access marks a chat as used,
+    # and once a minute the chats unused for max_idle seconds are forgotten.
+    def __init__(self, max_idle=3600):
+        self.max_idle = max_idle
+        self._values = {}
+        self._used = {}
+        self._lock = threading.RLock()
+        self._swept = time.monotonic()
+
+    def __len__(self):
+        return len(self._values)
+
+    def _touch(self, chat_id):
+        now = time.monotonic()
+        self._used[chat_id] = now
+        if now - self._swept > 60:
+            self._swept = now
+            self.evict_idle()
+
+    def _forget(self, chat_id):
+        self._used.pop(chat_id, None)
+        return self._values.pop(chat_id, None)
+
+    def evict_idle(self):
+        # Returns the number of chats dropped from memory.
+        with self._lock:
+            deadline = time.monotonic() - self.max_idle
+            idle = [chat_id for chat_id, used in self._used.items() if used < deadline]
+            for chat_id in idle:
+                self._forget(chat_id)
+            return len(idle)
+
+
+class ChatHistories(_IdleMap):
+    # The ChatHistory of every chat talking to one provider, loaded from the store when the chat speaks.
+    # Supports the parts of the dict interface the bot uses: "in" and pop, which returns a bool.
+    def __init__(self, provider, store=None, max_tokens=3000, system_prompt="", max_idle=3600):
+        super().__init__(max_idle)
+        self.provider = provider
+        self.store = store
+        self.max_tokens = max_tokens
+        self.system_prompt = system_prompt
+
+    def __contains__(self, chat_id):
+        with self._lock:
+            if chat_id in self._values:
+                return True
+        return self.store is not None and self.store.has_messages(self.provider, chat_id)
+
+    def history(self, chat_id):
+        # Returns the history of chat_id, loading it from the store or creating it if necessary.
+        with self._lock:
+            history = self._values.get(chat_id)
+            if history is None:
+                history = ChatHistory(self.max_tokens, self.system_prompt)
+                if self.store is not None:
+                    for role, content in self.store.load_messages(self.provider, chat_id):
+                        history.append(role, content)
+                    history.on_append = lambda role, content: self.store.add_message(self.provider, chat_id, role, content)
+                self._values[chat_id] = history
+            self._touch(chat_id)
+            return history
+
+    def pop(self, chat_id):
+        # Deletes the history of chat_id, from memory and from the store.
+        # Unlike dict.pop it returns whether there was one, that is all the bot needs, and a history only on disk isn't loaded for it.
+        with self._lock:
+            found = self._forget(chat_id) is not None
+        if self.store is not None:
+            found = self.store.delete_messages(self.provider, chat_id) or found
+        return found
+
+
+class ChatChoices(_IdleMap):
+    # Which AI each chat talks to (Bot.chats), read from the store when the chat speaks.
+    # Supports the parts of the dict interface the bot uses: "in", [] and pop.
+    def __init__(self, store=None, max_idle=3600):
+        super().__init__(max_idle)
+        self.store = store
+
+    def get(self, chat_id, default=None):
+        with self._lock:
+            provider = self._values.get(chat_id)
+            if provider is None and self.store is not None:
+                provider = self.store.get_choice(chat_id)
+                if provider is not None:
+                    self._values[chat_id] = provider
+            if provider is None:
+                return default
+            self._touch(chat_id)
+            return provider
+
+    def __contains__(self, chat_id):
+        return self.get(chat_id) is not None
+
+    def __getitem__(self, chat_id):
+        provider = self.get(chat_id)
+        if provider is None:
+            raise KeyError(chat_id)
+        return provider
+
+    def __setitem__(self, chat_id, provider):
+        with self._lock:
+            self._values[chat_id] = provider
+            self._touch(chat_id)
+        if self.store is not None:
+            self.store.set_choice(chat_id, provider)
+
+    def pop(self, chat_id, default=None):
+        provider = self.get(chat_id)
+        with self._lock:
+            self._forget(chat_id)
+        if self.store is not None:
+            self.store.delete_choice(chat_id)
+        return default if provider is None else provider
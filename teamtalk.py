@@ -8,13 +8,26 @@ http://github.com/cartertemm/pyteamtalk
 """
 
 
+import re
 import shlex
+import collections
+import concurrent.futures
 import time
+import asyncio
+import inspect
 import threading
-import telnetlib
 import warnings
 import functools
 
+with warnings.catch_warnings():
+	warnings.simplefilter("ignore", DeprecationWarning)
+	try:
+		import telnetlib
+	except ImportError:
+		# removed from the standard library in Python 3.13
+		# only TeamTalkServer needs it, AsyncTeamTalkServer works with asyncio streams instead
+		telnetlib = None
+
 
 # constants
 ## MSG Types
@@ -141,6 +154,25 @@ SUBSCRIBE_INTERCEPT_DESKTOP	 = 0x00400000
 SUBSCRIBE_INTERCEPT_MEDIAFILE = 0x01000000
 SUBSCRIBE_INTERCEPT_ALL = 0x017B0000
 
+## State tracking categories
+# The internal events that keep self.users, self.channels and self.files up to date
+STATE_EVENTS = {
+	"users": ("loggedin", "adduser", "removeuser", "updateuser"),
+	"channels": ("addchannel", "updatechannel", "removechannel"),
+	"files": ("addfile", "removefile"),
+}
+
+## Command ids
+# ids assigned by send_command wrap around after this
+MAX_COMMAND_ID = 32767
+
+## Send priorities
+# control lines (ping, login, join, ...) are written before any chat line and are never rate limited
+PRIORITY_CONTROL = 0
+PRIORITY_CHAT = 1
+# commands sent in bulk (subscribing to every user of a channel, ...) share the rate limit of chat lines and only use what chat leaves over
+PRIORITY_BULK = 2
+
 
 def split_parts(msg):
 	"""Splits a key=value pair into a tuple."""
@@ -148,89 +180,211 @@ def split_parts(msg):
 	return (msg[:index], msg[index+1:])
 
 
+## Field types
+# Fields whose type never changes, no matter which event carries them.
+# Anything not listed here is guessed from the way it was sent: quoted values are strings, bare digits are ints.
+FIELD_TYPES = {
+	"id": int,
+	"userid": int,
+	"srcuserid": int,
+	"destuserid": int,
+	"chanid": int,
+	"parentid": int,
+	"fileid": int,
+	"type": int,
+	"number": int,
+	"usertype": int,
+	"userrights": int,
+	"statusmode": int,
+	"sublocal": int,
+	"subpeer": int,
+	"opstatus": int,
+	"usertimeout": int,
+	"maxusers": int,
+	"filesize": int,
+	"nickname": str,
+	"username": str,
+	"password": str,
+	"content": str,
+	"message": str,
+	"statusmsg": str,
+	"channel": str,
+	"name": str,
+	"topic": str,
+	"filename": str,
+	"clientname": str,
+	"servername": str,
+	"motd": str,
+	"version": str,
+	"protocol": str,
+	"ipaddr": str,
+	"note": str,
+}
+
+# Per-event additions and overrides for FIELD_TYPES
+EVENT_FIELD_TYPES = {
+	"teamtalk": {"udpport": int, "tcpport": int},
+	"serverupdate": {"maxloginattempts": int, "maxloginsperip": int, "udpport": int, "tcpport": int},
+	"addchannel": {"diskquota": int, "maxusers": int},
+	"updatechannel": {"diskquota": int, "maxusers": int},
+}
+
+# a complete key=value pair, where value is a quoted string (with escapes), a [list], or a bare word
+_FIELD_RE = re.compile(r'([^\s=]+)=("(?:[^"\\]|\\.)*"|\[[^\]]*\]|\S*)')
+# anything that has to be skipped as a whole while splitting, or a space to split on
+_SPLIT_RE = re.compile(r'\\.|"(?:[^"\\]|\\.)*"?| ')
+_ESCAPE_RE = re.compile(r"\\(.)")
+_ESCAPES = {"n": "\n", "r": "\r"}
+
+_field_types_cache = {}
+
+
+def field_types(event):
+	"""Returns the field type table for event, merged with the event independent FIELD_TYPES"""
+	types = _field_types_cache.get(event)
+	if types is None:
+		types = dict(FIELD_TYPES)
+		types.update(EVENT_FIELD_TYPES.get(event, {}))
+		_field_types_cache[event] = types
+	return types
+
+
+def _unescape_match(match):
+	char = match.group(1)
+	return _ESCAPES.get(char, char)
+
+
+def unescape(value):
+	"""Reverses the escaping TeamTalk applies to quoted strings"""
+	if "\\" not in value:
+		return value
+	return _ESCAPE_RE.sub(_unescape_match, value)
+
+
+def _is_int(value):
+	return value.isdigit() or (value[:1] == "-" and value[1:].isdigit())
+
+
+def _parse_value(value, kind=None):
+	"""Converts a single raw value to its python type.
+	kind is the type from the field type tables, or None when the field is unknown"""
+	first = value[:1]
+	if first == '"':
+		value = unescape(value[1:-1])
+		if kind is int and _is_int(value):
+			return int(value)
+		return value
+	if first == "[":
+		# Lists take the form [x,y,z]
+		value = value[1:-1]
+		# Make sure we aren't dealing with a blank list
+		if not value:
+			return []
+		# I've never once seem values take a form other than int
+		# better to assume it is possible, however
+		return [int(val) if _is_int(val) else _parse_value(val, str) for val in value.split(",")]
+	if kind is not str and _is_int(value):
+		return int(value)
+	return value
+
+
 def split_quoted(message):
 	"""Like shlex.split, but preserves quotes."""
-	pos = -1
-	inquote = False
-	buffer = ""
 	final = []
-	while pos < len(message)-1:
-		pos += 1
-		token = message[pos]
-		if token == " " and not inquote:
-			final.append(buffer)
-			buffer = ""
-			continue
-		if token == "\"" and message[pos-1] != "\\":
-			inquote = not inquote
-		buffer += token
-	final.append(buffer)
+	start = 0
+	for match in _SPLIT_RE.finditer(message):
+		if match.group() == " ":
+			final.append(message[start:match.start()])
+			start = match.end()
+	final.append(message[start:])
 	return final
 
 
 def parse_tt_message(message):
 	"""Parses a message sent by Teamtalk.
-	Also preserves datatypes.
+	Also preserves datatypes, using FIELD_TYPES and EVENT_FIELD_TYPES for known fields.
 	Returns a tuple of (event, parameters)"""
-	params = {}
 	message = message.strip()
-	message = split_quoted(message)
-	event = message[0]
-	message.remove(event)
-	for item in message:
-		k, v = split_parts(item)
-		# Lists take the form [x,y,z]
-		if v.startswith("[") and v.endswith("]"):
-			v = v.strip("[]")
-			# Make sure we aren't dealing with a blank list
-			if v:
-				v = v.split(",")
-				lst = []
-				for val in v:
-					if val.isdigit():
-						lst.append(int(val))
-					# I've never once seem values take a form other than int
-					# better to assume it is possible, however
-					else:
-						lst.append(val)
-				v = lst
-			else:
-				v = []
-		# preserve ints
-		elif v.isdigit():
-			v = int(v)
-		# strings
-		elif v.startswith('"') and v.endswith('"'):
-			v = v[1:-1]
-		params[k] = v
+	event, _, message = message.partition(" ")
+	types = field_types(event.lower())
+	params = {}
+	for key, value in _FIELD_RE.findall(message):
+		params[key] = _parse_value(value, types.get(key))
 	return event, params
 
 
+# Lines for the commands sent most often, every chunk of every reply is one of these.
+# message type -> (the parameter naming the recipient, the line up to the content, the line between the content and the recipient)
+_MESSAGE_TEMPLATES = {
+	USER_MSG: ("destuserid", 'message type=1 content="', '" destuserid='),
+	CHANNEL_MSG: ("chanid", 'message type=2 content="', '" chanid='),
+}
+
+
+def escape(value):
+	"""Escapes a string for use between quotes, inverse of unescape"""
+	# most strings need none of the replacements, and looking for a character is much cheaper than replacing it
+	if "\\" in value:
+		value = value.replace("\\", "\\\\")
+	if '"' in value:
+		value = value.replace('"', '\\"')
+	if "\n" in value:
+		value = value.replace("\n", "\\n")
+	if "\r" in value:
+		value = value.replace("\r", "\\r")
+	return value
+
+
+def _build_value(val):
+	# integers aren't encapsulated in quotes
+	if isinstance(val, int) or isinstance(val, str) and val.isdigit():
+		return str(val)
+	# nor are lists
+	if isinstance(val, list):
+		return "[" + ",".join(_build_value(v) for v in val) + "]"
+	return '"' + escape(val) + '"'
+
+
+def _build_message(params):
+	"""Fills in a template for a message command to a user or a channel.
+	Returns None if params are anything else, so the general path can build the line"""
+	template = _MESSAGE_TEMPLATES.get(params.get("type"))
+	if template is None:
+		return None
+	target, start, middle = template
+	content = params.get("content")
+	dest = params.get(target)
+	id = params.get("id")
+	if len(params) != (3 if id is None else 4) or type(content) is not str or type(dest) is not int:
+		return None
+	line = start + escape(content) + middle + str(dest)
+	if id is None:
+		return line
+	if type(id) is not int:
+		return None
+	return line + " id=" + str(id)
+
+
 def build_tt_message(event, params):
 	"""Given an event and dictionary containing parameters, builds a TeamTalk message.
-	Also preserves datatypes.
+	Also preserves datatypes, and escapes quotes, backslashes and line breaks in strings.
 	inverse of parse_tt_message"""
-	message = event
+	if not params:
+		return event
+	if event == "message":
+		line = _build_message(params)
+		if line is not None:
+			return line
+	parts = [event]
 	for key, val in params.items():
-		message += " " + key + "="
-		# integers aren't encapsulated in quotes
-		if isinstance(val, int) or isinstance(val, str) and val.isdigit():
-			message += str(val)
-		# nor are lists
-		elif isinstance(val, list):
-			message += "["
-			for v in val:
-				if isinstance(v, int) or isinstance(v, str) and v.isdigit():
-					message += str(v) + ","
-				else:
-					message += '"' + v + '",'
-			# get rid of the trailing ",", if necessary
-			if len(val) > 0:
-				message = message[:-1]
-			message += "]"
-		else:
-			message += '"' + val + '"'
-	return message
+		parts.append(key + "=" + _build_value(val))
+	return " ".join(parts)
+
+
+@functools.lru_cache(maxsize=64)
+def _encode_constant(line):
+	"""Encodes a line without parameters, like ping, which is the same every time"""
+	return line.encode() + b"\r\n"
 
 
 class TeamTalkError(Exception):
@@ -240,28 +394,417 @@ class TeamTalkError(Exception):
 		self.message = message
 
 	def __str__(self):
-		return "[" + self.code + "]: " + self.message
+		return f"[{self.code}]: {self.message}"
+
+
+class Registry:
+	"""A collection of dicts (users, channels or files) indexed by a primary key and any number of secondary fields.
+	Every lookup is a dictionary access instead of a scan over the whole collection.
+	Secondary fields need not be unique (two users can share a nickname), so each value maps to every item that has it.
+	Items lacking a secondary field are indexed under None.
+	Always change stored items through add, update and pop_field so that the indexes stay correct.
+	"""
+
+	def __init__(self, key, *fields):
+		self.key = key
+		self.fields = fields
+		self._items = {}
+		self._indexes = {field: {} for field in fields}
+
+	def __len__(self):
+		return len(self._items)
+
+	def __iter__(self):
+		# iterate over a copy, the reader thread may change the registry at any time
+		return iter(list(self._items.values()))
+
+	def __contains__(self, primary):
+		return primary in self._items
+
+	def __getitem__(self, primary):
+		return self._items[primary]
+
+	def get(self, primary):
+		"""Returns the item stored under primary, or None"""
+		return self._items.get(primary)
+
+	def find(self, field, value):
+		"""Returns the first item whose field equals value, or None"""
+		bucket = self._indexes[field].get(value)
+		if bucket:
+			return next(iter(bucket.values()))
+
+	def find_all(self, field, value):
+		"""Returns a list of every item whose field equals value"""
+		return list(self._indexes[field].get(value, {}).values())
+
+	def add(self, item):
+		"""Stores item, or merges it into the already stored item with the same key.
+		Returns the stored item"""
+		primary = item[self.key]
+		if primary in self._items:
+			return self.update(primary, item)
+		self._items[primary] = item
+		for field in self.fields:
+			self._indexes[field].setdefault(item.get(field), {})[primary] = item
+		return item
+
+	def update(self, primary, params):
+		"""Merges params into the item stored under primary.
+		Returns the updated item, or None if there is no such item"""
+		item = self._items.get(primary)
+		if item is None:
+			return
+		for field in self.fields:
+			if field in params and params[field] != item.get(field):
+				self._unindex(field, item.get(field), primary)
+				self._indexes[field].setdefault(params[field], {})[primary] = item
+		item.update(params)
+		return item
+
+	def pop_field(self, primary, field, default=None):
+		"""Removes field from the item stored under primary and returns its value"""
+		item = self._items.get(primary)
+		if item is None or field not in item:
+			return default
+		if field in self._indexes:
+			self._unindex(field, item[field], primary)
+			self._indexes[field].setdefault(None, {})[primary] = item
+		return item.pop(field)
+
+	def remove(self, primary):
+		"""Removes and returns the item stored under primary, or None if there is no such item"""
+		item = self._items.pop(primary, None)
+		if item is not None:
+			for field in self.fields:
+				self._unindex(field, item.get(field), primary)
+		return item
+
+	def clear(self):
+		self._items.clear()
+		for index in self._indexes.values():
+			index.clear()
+
+	def _unindex(self, field, value, primary):
+		bucket = self._indexes[field].get(value)
+		if bucket is not None:
+			bucket.pop(primary, None)
+			if not bucket:
+				del self._indexes[field][value]
+
+
+class TokenBucket:
+	"""Allows rate operations per second on average, in bursts of up to burst operations."""
+
+	def __init__(self, rate, burst, now=None):
+		self.rate = rate
+		self.burst = burst
+		self.tokens = burst
+		self.updated = time.monotonic() if now is None else now
+
+	def _refill(self, now):
+		if now > self.updated:
+			self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+			self.updated = now
+
+	def wait_time(self, now):
+		"""Returns the number of seconds until a token is available, 0 if one is available now"""
+		self._refill(now)
+		if self.tokens >= 1:
+			return 0
+		return (1 - self.tokens) / self.rate
+
+	def take(self, now):
+		self._refill(now)
+		self.tokens -= 1
+
+	def full(self, now):
+		self._refill(now)
+		return self.tokens >= self.burst
+
+
+class SendScheduler:
+	"""Decides which queued lines may be written and when.
+	Control lines always go first. Chat lines need a token from the global bucket as well as from the bucket of their destination,
+	and destinations take turns so that one long answer can't hold back the answers for everybody else.
+	Bulk lines need a token from the global bucket too, but only get the ones no chat line is ready for.
+	backoff is called when the server replies with CMD_ERR_COMMAND_FLOOD: it halves the global rate (down to min_rate) and empties the bucket,
+	which slows down chat and bulk lines alike.
+	The rate doubles again, up to the configured one, for every recovery_time seconds without another flood error.
+	Not thread safe, LineWriter and AsyncTeamTalkServer guard it with their own locks.
+	"""
+
+	def __init__(self, rate=8, burst=10, destination_rate=2, destination_burst=4, min_rate=0.5, recovery_time=10):
+		self.max_rate = rate
+		self.min_rate = min_rate
+		self.recovery_time = recovery_time
+		self.destination_rate = destination_rate
+		self.destination_burst = destination_burst
+		self.global_bucket = TokenBucket(rate, burst)
+		self.buckets = {}
+		self.control = collections.deque()
+		# destination -> lines waiting for it, ordered by whose turn it is
+		self.chat = collections.OrderedDict()
+		self.bulk = collections.deque()
+		self.pending_lines = 0
+		self.pending_bytes = 0
+		# everything handed out by pop, that is everything written to the connection
+		self.lines_sent = 0
+		self.bytes_sent = 0
+		self.floods = 0
+		self.flooded_at = None
+
+	def __len__(self):
+		return self.pending_lines
+
+	def push(self, line, priority=PRIORITY_CONTROL, destination=None):
+		if priority == PRIORITY_CONTROL:
+			self.control.append(line)
+		elif priority == PRIORITY_BULK:
+			self.bulk.append(line)
+		else:
+			queue = self.chat.get(destination)
+			if queue is None:
+				queue = self.chat[destination] = collections.deque()
+			queue.append(line)
+		self.pending_lines += 1
+		self.pending_bytes += len(line)
+
+	def clear(self):
+		"""Drops every queued line"""
+		self.control.clear()
+		self.chat.clear()
+		self.bulk.clear()
+		self.pending_lines = 0
+		self.pending_bytes = 0
+
+	def backoff(self, now=None):
+		"""Slows chat and bulk lines down after the server complained about flooding"""
+		now = time.monotonic() if now is None else now
+		self.floods += 1
+		self.flooded_at = now
+		self.global_bucket.rate = max(self.min_rate, self.global_bucket.rate / 2)
+		self.global_bucket.tokens = 0
+		self.global_bucket.updated = now
+
+	def pop(self, now, max_bytes):
+		"""Removes and returns (lines, wait): the lines that may be written now, at most max_bytes of them unless the first is bigger,
+		and the number of seconds until the next chat or bulk line becomes ready (None when nothing else is waiting)"""
+		self._recover(now)
+		lines = []
+		size = 0
+		while self.control and (not lines or size + len(self.control[0]) <= max_bytes):
+			line = self.control.popleft()
+			lines.append(line)
+			size += len(line)
+		progressed = True
+		while progressed and self.chat:
+			progressed = False
+			for destination in list(self.chat):
+				if self.global_bucket.wait_time(now):
+					break
+				queue = self.chat[destination]
+				if lines and size + len(queue[0]) > max_bytes:
+					break
+				bucket = self._bucket(destination, now)
+				if bucket.wait_time(now):
+					continue
+				line = queue.popleft()
+				lines.append(line)
+				size += len(line)
+				self.global_bucket.take(now)
+				bucket.take(now)
+				progressed = True
+				if queue:
+					self.chat.move_to_end(destination)
+				else:
+					del self.chat[destination]
+		while self.bulk and not self.global_bucket.wait_time(now) and (not lines or size + len(self.bulk[0]) <= max_bytes):
+			line = self.bulk.popleft()
+			lines.append(line)
+			size += len(line)
+			self.global_bucket.take(now)
+		self.pending_lines -= len(lines)
+		self.pending_bytes -= size
+		self.lines_sent += len(lines)
+		self.bytes_sent += size
+		return lines, self._wait_time(now)
+
+	def _wait_time(self, now):
+		if self.control:
+			return 0
+		if self.bulk:
+			# a bulk line only needs a global token
+			return self.global_bucket.wait_time(now)
+		if not self.chat:
+			return
+		wait = min(self._bucket(destination, now).wait_time(now) for destination in self.chat)
+		return max(wait, self.global_bucket.wait_time(now))
+
+	def _bucket(self, destination, now):
+		bucket = self.buckets.get(destination)
+		if bucket is None:
+			if len(self.buckets) > 1024:
+				# forget destinations whose budget has fully recovered, they behave exactly like new ones
+				for key in [key for key, value in self.buckets.items() if key not in self.chat and value.full(now)]:
+					del self.buckets[key]
+			bucket = self.buckets[destination] = TokenBucket(self.destination_rate, self.destination_burst, now)
+		return bucket
+
+	def _recover(self, now):
+		if self.flooded_at is not None and now - self.flooded_at >= self.recovery_time:
+			self.global_bucket.rate = min(self.max_rate, self.global_bucket.rate * 2)
+			self.flooded_at = None if self.global_bucket.rate >= self.max_rate else now
+
+
+class LineWriter:
+	"""Serializes every write to a connection through one thread.
+	put may be called from any thread. Lines are handed out by a SendScheduler, and lines that are ready at the same time are coalesced into a single write of up to batch_bytes.
+	Memory is bounded by max_bytes: once that many bytes are waiting, put blocks until the writer catches up (or timeout expires).
+	"""
+
+	def __init__(self, write, scheduler=None, max_bytes=256 * 1024, batch_bytes=16 * 1024):
+		self._write = write
+		self.scheduler = scheduler if scheduler is not None else SendScheduler()
+		self.max_bytes = max_bytes
+		self.batch_bytes = batch_bytes
+		self._condition = threading.Condition()
+		self._writing = False
+		self.closed = False
+		self.lines_written = 0
+		self.bytes_written = 0
+		self.writes = 0
+		# time.monotonic() of the last successful write
+		self.last_write = 0.0
+		self.thread = threading.Thread(target=self._run, daemon=True)
+
+	@property
+	def pending_lines(self):
+		return self.scheduler.pending_lines
+
+	@property
+	def pending_bytes(self):
+		return self.scheduler.pending_bytes
+
+	def start(self):
+		self.thread.start()
+
+	def put(self, line, timeout=None, priority=PRIORITY_CONTROL, destination=None):
+		"""Queues line (bytes) for writing.
+		Returns False if the writer is closed, or still full after timeout seconds"""
+		with self._condition:
+			# a line bigger than max_bytes is still accepted once the queue is empty, otherwise it could never be sent
+			if not self._condition.wait_for(lambda: self.closed or not self.scheduler.pending_lines or self.scheduler.pending_bytes + len(line) <= self.max_bytes, timeout):
+				return False
+			if self.closed:
+				return False
+			self.scheduler.push(line, priority, destination)
+			self._condition.notify_all()
+		return True
+
+	def backoff(self):
+		"""Tells the scheduler that the server reported a command flood"""
+		with self._condition:
+			self.scheduler.backoff()
+
+	def flush(self, timeout=None):
+		"""Blocks until everything queued so far has been written.
+		Returns False on timeout"""
+		with self._condition:
+			return self._condition.wait_for(lambda: not self.scheduler.pending_lines and not self._writing, timeout)
+
+	def close(self, timeout=None):
+		"""Writes whatever is still queued (waiting at most timeout seconds), then stops the writer thread"""
+		if self.thread.is_alive():
+			self.flush(timeout)
+		with self._condition:
+			self.closed = True
+			self._condition.notify_all()
+
+	def _run(self):
+		while True:
+			with self._condition:
+				if self.closed:
+					return
+				lines, wait = self.scheduler.pop(time.monotonic(), self.batch_bytes)
+				if not lines:
+					# nothing queued (wait is None) or the rate limits say not yet
+					self._condition.wait(wait)
+					continue
+				self._writing = True
+				# room was freed for blocked senders
+				self._condition.notify_all()
+			data = b"".join(lines)
+			try:
+				self._write(data)
+				self.last_write = time.monotonic()
+				self.writes += 1
+				self.lines_written += len(lines)
+				self.bytes_written += len(data)
+			except (AttributeError, OSError):
+				# the connection is gone, nothing queued can be delivered anymore
+				with self._condition:
+					self.closed = True
+					self.scheduler.clear()
+			finally:
+				with self._condition:
+					self._writing = False
+					self._condition.notify_all()
 
 
 class TeamTalkServer:
 	"""Represents a single TeamTalk server."""
 
+	# bytes allowed to wait in the outbound queue before send blocks
+	send_queue_bytes = 256 * 1024
+	# seconds send may block on a full queue before the line is dropped
+	send_timeout = 10
+	# seconds disconnect waits for queued lines to be written
+	flush_timeout = 2
+	# chat messages allowed per second, overall and to a single user or channel, and how many may be sent in a burst
+	# pings and other commands are never held back, unless they are sent with PRIORITY_BULK
+	send_rate = 8
+	send_burst = 10
+	destination_rate = 2
+	destination_burst = 4
+	# seconds without receiving anything, not even a pong, after which the connection is considered dead
+	# None derives it from the server's usertimeout
+	receive_timeout = None
+
 	def __init__(self, host=None, tcpport=10333):
 		self.set_connection_info(host, tcpport)
 		self.con = None
+		self.line_writer = None
+		self.scheduler = None
 		self.pinger_thread = None
 		self.message_thread = None
+		# set to wake the pinger early, on disconnect or when usertimeout changes
+		self._pinger_wakeup = threading.Event()
 		self.disconnecting = False
+		# time.monotonic() of the last line received
+		self.last_received = 0.0
 		self.logging_in = False
 		self.logged_out = False
 		self.current_id = 0
 		self.last_id = 0
+		# id -> (future, [(event, params), ...]) for commands sent through send_command
+		self._commands = {}
+		self._commands_lock = threading.Lock()
 		self.subscriptions = {}
-		self.channels = []
-		self.users = []
+		self.channels = Registry("chanid", "channel")
+		self.users = Registry("userid", "nickname", "username", "chanid")
 		self.me = {}
 		self.server_params = {}
-		self.files = []
+		self.files = Registry("fileid", "filename", "chanid")
+		# when True, lines for events nobody is subscribed to are dropped before their parameters are parsed
+		self.lazy_parsing = True
+		self.tracking = {category: True for category in STATE_EVENTS}
+		# metrics recorded while handling lines, see set_metrics
+		self._events_total = None
+		self._errors_total = None
+		self._dispatch_seconds = None
+		# wrapped around every subscriber call, see add_middleware
+		self.middleware = []
 		self._subscribe_to_internal_events()
 		self._login_sequence = 0
 
@@ -274,9 +817,46 @@ class TeamTalkServer:
 	def connect(self):
 		"""Initiates the connection to this server
 		Raises an exception on failure"""
+		if telnetlib is None:
+			raise RuntimeError("telnetlib is not available on this version of Python, use AsyncTeamTalkServer instead")
 		self.con = telnetlib.Telnet(self.host, self.tcpport)
+		# every thread sends through this queue, so writes can't interleave and are batched while the socket is busy
+		self.scheduler = self._create_scheduler()
+		self.line_writer = LineWriter(self.con.write, self.scheduler, max_bytes=self.send_queue_bytes)
+		self.line_writer.start()
+		self.last_received = time.monotonic()
 		# the first thing we should get is a welcome message
 		welcome = self.read_line(timeout=3)
+		self._handle_welcome(welcome)
+
+	def reset(self):
+		"""Forgets the connection and everything learned through it, so that connect and login can be called again after a disconnect.
+		Subscriptions, middleware, metrics and state tracking are kept"""
+		if self.pinger_thread and self.pinger_thread is not threading.current_thread():
+			# it was woken by disconnect, and must see self.disconnecting before it is cleared
+			self.pinger_thread.join(1)
+		self._reset_state()
+
+	def _reset_state(self):
+		self.con = None
+		self.line_writer = None
+		self.scheduler = None
+		self.disconnecting = False
+		self.last_received = 0.0
+		self.logging_in = False
+		self.logged_out = False
+		self.current_id = 0
+		self._login_sequence = 0
+		self._pinger_wakeup.clear()
+		self.channels.clear()
+		self.users.clear()
+		self.files.clear()
+		self.me = {}
+		self.server_params = {}
+
+	def _handle_welcome(self, welcome):
+		"""Checks the first line sent by the server and stores its parameters.
+		Shared by every transport"""
 		if not welcome:
 			raise TimeoutError("Server failed to send welcome message in time")
 		welcome = welcome.decode()
@@ -287,14 +867,10 @@ class TeamTalkServer:
 			return
 		self.server_params = params
 
-	def login(self, nickname, username, password, client, protocol="5.6", version="1.0", callback=None):
-		"""Attempts to log in to the server.
-		This should be called immediately after connect to prevent timing out.
-		Blocks until the login sequence has completed.
-		If callback is specified, it behaves the same as handle_messages for the duration of this sequence.
-		To intersept failed logins, provide a callback and check for the "error" event.
-		"""
-		message = build_tt_message(
+	@staticmethod
+	def _build_login(nickname, username, password, client, protocol, version):
+		"""Builds the login command. Always uses id 1 so the login flood can be recognized"""
+		return build_tt_message(
 			"login",
 			{
 				"nickname": nickname,
@@ -306,6 +882,15 @@ class TeamTalkServer:
 				"id": 1,
 			},
 		)
+
+	def login(self, nickname, username, password, client, protocol="5.6", version="1.0", callback=None):
+		"""Attempts to log in to the server.
+		This should be called immediately after connect to prevent timing out.
+		Blocks until the login sequence has completed.
+		If callback is specified, it behaves the same as handle_messages for the duration of this sequence.
+		To intersept failed logins, provide a callback and check for the "error" event.
+		"""
+		message = self._build_login(nickname, username, password, client, protocol, version)
 		self.send(message)
 		self.start_threads()
 		self._login_sequence = 1
@@ -322,27 +907,49 @@ class TeamTalkServer:
 			return False
 		return self.con.read_until(b"\r\n", timeout)
 
-	def send(self, line):
-		"""Sends a line to the server"""
-		if self.disconnecting:
-			return False
+	@staticmethod
+	def _encode_line(line):
+		"""Converts a line to the bytes that are actually written to the socket"""
 		if isinstance(line, str):
+			if line.isalnum():
+				return _encode_constant(line)
 			line = line.encode()
 		line = line.replace(b"\n", b"\r")
 		if not line.endswith(b"\r\n"):
 			line += b"\r\n"
-		try:
-			self.con.write(line)
-		except AttributeError:
-			# sometimes when trying to send the line to the server, the client will get disconnected and the connection object will be distroyed
-			# if this happens, a AttributeError will raise and we just ignore it. hopefully in the next command the app will notice the disconnecting status
-			pass
+		return line
+
+	def _create_scheduler(self):
+		return SendScheduler(self.send_rate, self.send_burst, self.destination_rate, self.destination_burst)
+
+	def send(self, line, priority=PRIORITY_CONTROL, destination=None):
+		"""Queues a line to be sent to the server.
+		priority is PRIORITY_CONTROL, PRIORITY_CHAT or PRIORITY_BULK, chat lines are paced per destination (any hashable naming the recipient)
+		Safe to call from any thread. Returns False if the line could not be queued"""
+		if self.disconnecting or not self.line_writer:
+			return False
+		return self.line_writer.put(self._encode_line(line), self.send_timeout, priority, destination)
+
+	def _backoff(self):
+		"""Slows chat messages and bulk commands down after a command flood error"""
+		self.line_writer.backoff()
+
+	def queue_depth(self):
+		"""Returns the number of lines waiting to be written to the server"""
+		if self.scheduler is None:
+			return 0
+		return self.scheduler.pending_lines
 
 	def disconnect(self):
 		"""Disconnect from this server.
+		Lines queued before the call are written first (for up to flush_timeout seconds)
 		Signals all threads to stop"""
 		self.disconnecting = True
+		self._pinger_wakeup.set()
+		if self.line_writer:
+			self.line_writer.close(self.flush_timeout)
 		self.con.close()
+		self._fail_commands()
 
 	def handle_messages(self, timeout=1, callback=None):
 		"""Processes all incoming messages
@@ -361,62 +968,158 @@ class TeamTalkServer:
 				# Sometimes during timeout reading the bot will be disconnected and the socket object has been already destroyed.
 				# this issue raises AttributeError and. we just send the while loop to next iteration and the loop checks for disconnecting status and the problem will be resolved peacefully.
 				continue
-			line = line.strip()
-			if line == b"pong":
-				# response to ping, which is handled internally
-				# we don't actually care about getting something back, we just send them to make the server happy
-				line = b"" # drop it
-			try:
-				line = line.decode()
-			except UnicodeDecodeError:
-				print(b"failed to decode line: " + line)
-				if callable(callback):
-					callback(self, "", {})
-				continue
-			if not line:
-				if callable(callback):
-					callback(self, "", {})
-				continue # nothing to do
-			event, params = parse_tt_message(line)
-			event = event.lower()
-			if event == "error":
-				# indicates success or irrelevance
-				if params["number"] == CMD_ERR_IGNORE or params["number"] == CMD_ERR_SUCCESS:
-					continue
-				print(line)
-				# raise TeamTalkError(params["number"], params["message"])
-			# Call messages for the event if necessary
-			for func in self.subscriptions.get(event, []):
-				func(self, params)
-			# finally, call the callback
+			except (EOFError, OSError):
+				# the server closed the connection, or the network dropped it
+				self._connection_lost()
+				break
+			if not line and self._receive_timed_out():
+				self._connection_lost()
+				break
+			self._process_line(line, callback)
+
+	def _connection_lost(self):
+		"""Marks the connection as gone without disconnect having been called, which ends handle_messages.
+		disconnect should still be called to release it"""
+		if self.disconnecting:
+			# we asked for it
+			return
+		print(f"lost the connection to {self.host}:{self.tcpport}")
+		self.disconnecting = True
+		self._wake_pinger()
+
+	def _receive_timed_out(self):
+		"""True if nothing was received for receive_timeout seconds.
+		The pinger makes the server answer at least every ping interval, so a silent connection is a dead one, even without an error to say so"""
+		timeout = self.receive_timeout or 2 * self._ping_interval() + 10
+		return bool(self.last_received) and time.monotonic() - self.last_received > timeout
+
+	def _process_line(self, line, callback=None):
+		"""Decodes, parses and dispatches a single line received from the server.
+		Shared by every transport"""
+		if line:
+			self.last_received = time.monotonic()
+		line = line.strip()
+		if line == b"pong":
+			# response to ping, which is handled internally
+			# we don't actually care about getting something back, we just send them to make the server happy
+			line = b"" # drop it
+		try:
+			line = line.decode()
+		except UnicodeDecodeError:
+			print(b"failed to decode line: " + line)
+			if callable(callback):
+				callback(self, "", {})
+			return
+		if not line:
 			if callable(callback):
-				callback(self, event, params)
+				callback(self, "", {})
+			return # nothing to do
+		if self._events_total is not None:
+			self._events_total.inc(event=line.partition(" ")[0].lower())
+		if self.lazy_parsing and not callable(callback) and self.current_id not in self._commands:
+			# only the event name is needed to know whether anybody cares about this line
+			if not self.subscriptions.get(line.partition(" ")[0].lower()):
+				return
+		event, params = parse_tt_message(line)
+		event = event.lower()
+		command = self._commands.get(self.current_id)
+		if command is not None and event != "end":
+			# part of the response to a command sent through send_command
+			command[1].append((event, params))
+		if event == "error":
+			# indicates success or irrelevance
+			if params["number"] == CMD_ERR_IGNORE or params["number"] == CMD_ERR_SUCCESS:
+				return
+			if self._errors_total is not None:
+				self._errors_total.inc(number=params["number"])
+			print(line)
+			# raise TeamTalkError(params["number"], params["message"])
+		# Call messages for the event if necessary
+		dispatch_seconds = self._dispatch_seconds
+		for func in self.subscriptions.get(event, []):
+			if dispatch_seconds is None:
+				self._dispatch(event, func, params)
+				continue
+			start = time.perf_counter()
+			self._dispatch(event, func, params)
+			dispatch_seconds.observe(time.perf_counter() - start, event=event, subscriber=getattr(func, "__qualname__", repr(func)))
+		# finally, call the callback
+		if callable(callback):
+			callback(self, event, params)
+
+	def _dispatch(self, event, func, params):
+		"""Runs a single subscribed function for an event through the middleware"""
+		if not self.middleware:
+			return self._call_subscriber(func, params)
+		call = functools.partial(self._call_subscriber, func, params)
+		for middleware in reversed(self.middleware):
+			call = functools.partial(middleware, self, event, func, params, call)
+		return call()
+
+	def _call_subscriber(self, func, params):
+		"""Runs a single subscribed function for an event"""
+		func(self, params)
+
+	def add_middleware(self, middleware):
+		"""Wraps every subscriber call in middleware, called as middleware(server, event, func, params, call).
+		call() runs the next middleware, or the subscriber itself, and returns its result. Middleware added first is the outermost.
+		Subscribers run on the thread reading from the server, so middleware can time them, log them or profile them.
+		With AsyncTeamTalkServer, a coroutine subscriber is only scheduled by call(), its execution isn't included."""
+		self.middleware.append(middleware)
+
+	def remove_middleware(self, middleware):
+		"""Stops wrapping subscriber calls in middleware
+		Raises a ValueError if it wasn't added"""
+		self.middleware.remove(middleware)
 
 
 	def _sleep(self, seconds):
-		"""Like time.sleep, but immediately halts execution if we need to disconnect from a server"""
-		starttime = time.time()
-		while not self.disconnecting and time.time() - starttime <= seconds:
-			time.sleep(0.005)
+		"""Like time.sleep, but returns immediately if we need to disconnect from a server or the pinger was woken up.
+		Blocks on an event, so waiting costs no CPU at all"""
+		self._pinger_wakeup.wait(max(seconds, 0))
+		self._pinger_wakeup.clear()
+
+	def _wake_pinger(self):
+		"""Makes the pinger recompute its interval right away"""
+		self._pinger_wakeup.set()
+
+	def _last_sent(self):
+		"""Returns the time.monotonic() of the last write to the server"""
+		if not self.line_writer:
+			return 0.0
+		return self.line_writer.last_write
+
+	def _ping_delay(self):
+		"""Returns the number of seconds until a ping is due.
+		Any line written to the server keeps us from timing out, so pings are only needed once we've been quiet for a whole interval.
+		They are also sent once the server has been quiet for a whole interval, its pong shows that the connection is still alive"""
+		return self._ping_interval() - (time.monotonic() - min(self._last_sent(), self.last_received or float("inf")))
 
 	def handle_pings(self):
 		"""Handles pinging the server at a reasonable interval.
 		Intervals are calculated based on the server's usertimeout value.
+		Pings are skipped while other traffic is being sent.
 		This function always runs in it's own thread."""
-		pingtime = 0
 		while not self.disconnecting:
-			self.send("ping")
-			# in case usertimeout was changed somehow
-			# logic from TTCom, which had a preferable approach to TT clients for what we're doing
-			# better safe than sorry
-			pingtime = float(self.server_params.get("usertimeout", 0))
-			if pingtime < 1:
-				pingtime = 0.3
-			elif pingtime < 1.5:
-				pingtime = 0.5
-			else:
-				pingtime *= 0.75
-			self._sleep(pingtime)
+			delay = self._ping_delay()
+			if delay <= 0:
+				self.send("ping")
+				delay = self._ping_interval()
+			self._sleep(delay)
+
+	def _ping_interval(self):
+		"""Returns the number of seconds to wait between pings"""
+		# in case usertimeout was changed somehow
+		# logic from TTCom, which had a preferable approach to TT clients for what we're doing
+		# better safe than sorry
+		pingtime = float(self.server_params.get("usertimeout", 0))
+		if pingtime < 1:
+			pingtime = 0.3
+		elif pingtime < 1.5:
+			pingtime = 0.5
+		else:
+			pingtime *= 0.75
+		return pingtime
 
 	def subscribe(self, event, func=None):
 		"""Starts calling func every time event is encountered, passing along a copy of this class as well as the parameters from the TT message
@@ -456,31 +1159,65 @@ class TeamTalkServer:
 			if callable(func):
 				self.subscribe(event, func)
 
+	def set_metrics(self, registry, prefix="teamtalk"):
+		"""Starts recording metrics about this server into registry, or stops when registry is None.
+		registry is anything with counter, gauge and histogram methods like metrics.MetricsRegistry, whose metrics are created on first use and returned again after that.
+		Records events received per type, the time every subscriber takes per event, errors per number,
+		and reads lines and bytes sent, the send queue, floods and the number of known users and channels when the registry is read."""
+		if registry is None:
+			self._events_total = self._errors_total = self._dispatch_seconds = None
+			return
+		self._events_total = registry.counter(f"{prefix}_events_total", "Lines received from the server, by event")
+		self._errors_total = registry.counter(f"{prefix}_errors_total", "Errors sent by the server, by number")
+		self._dispatch_seconds = registry.histogram(f"{prefix}_dispatch_seconds", "Time spent in each subscriber, by event and subscriber")
+		registry.counter(f"{prefix}_lines_sent_total", "Lines written to the server since connecting", func=lambda: self.scheduler.lines_sent if self.scheduler is not None else 0)
+		registry.counter(f"{prefix}_bytes_sent_total", "Bytes written to the server since connecting", func=lambda: self.scheduler.bytes_sent if self.scheduler is not None else 0)
+		registry.counter(f"{prefix}_floods_total", "Command flood errors since connecting", func=lambda: self.scheduler.floods if self.scheduler is not None else 0)
+		registry.gauge(f"{prefix}_send_queue_lines", "Lines waiting to be written", func=self.queue_depth)
+		registry.gauge(f"{prefix}_send_queue_bytes", "Bytes waiting to be written", func=lambda: self.scheduler.pending_bytes if self.scheduler is not None else 0)
+		registry.gauge(f"{prefix}_users", "Users known on the server", func=lambda: len(self.users))
+		registry.gauge(f"{prefix}_channels", "Channels known on the server", func=lambda: len(self.channels))
+
+	def set_state_tracking(self, users=None, channels=None, files=None):
+		"""Switches keeping track of self.users, self.channels and self.files on or off.
+		Each argument can be True, False or None (leave unchanged)
+		When a category is switched off its list is cleared, since it would only go stale, and its events are no longer parsed unless something else subscribes to them.
+		"""
+		for category, enabled in (("users", users), ("channels", channels), ("files", files)):
+			if enabled is None or enabled == self.tracking[category]:
+				continue
+			self.tracking[category] = enabled
+			for event in STATE_EVENTS[category]:
+				func = getattr(self, "_handle_" + event)
+				if enabled:
+					# internal handlers take precedence over custom responses
+					self.subscriptions.setdefault(event, []).insert(0, func)
+				else:
+					self.unsubscribe(event, func)
+			if not enabled:
+				getattr(self, category).clear()
+
 	def get_channel(self, id, index=False):
 		"""Retrieves attributes for channels with the requested id.
-		If index is False, returns a dict. Otherwise, returns the channel's index in self.channels
+		If index is False, returns a dict. Otherwise, returns the channel's key in self.channels (its chanid)
 		If id is of type str, look for matching names
 		If id is an int, look for matching chanid's
 		If id is a dict, we assume params are lazily being passed and try searching for a chanid"""
 		if isinstance(id, dict):
 			id = id.get("chanid")
-			if not id:
-				return
-		found = False
-		for i, channel in enumerate(self.channels):
-			if isinstance(id, int) and channel["chanid"] == id:
-				found = True
-			elif isinstance(id, str) and channel["channel"] == id:
-				found = True
-			if found:
-				if index:
-					return i
-				else:
-					return channel
+		if isinstance(id, int):
+			channel = self.channels.get(id)
+		elif isinstance(id, str):
+			channel = self.channels.find("channel", id)
+		else:
+			return
+		if channel is not None and index:
+			return channel["chanid"]
+		return channel
 
 	def get_user(self, id, index=False):
 		"""Retrieves attributes for users with the requested id.
-		If index is False, returns a dict. Otherwise, returns the user's index in self.users
+		If index is False, returns a dict. Otherwise, returns the user's key in self.users (its userid)
 		If id is of type str, look for matching nicknames
 			Be careful, though, as teamtalk imposes no limit on users with identical nicknames.
 		If id is an int, look for matching userids
@@ -488,60 +1225,59 @@ class TeamTalkServer:
 		"""
 		if isinstance(id, dict):
 			id = id.get("userid")
-			if not id:
-				return
-		found = False
-		for i, user in enumerate(self.users):
-			if isinstance(id, int) and user["userid"] == id:
-				found = True
-			elif isinstance(id, str) and user["nickname"] == id:
-				found = True
-			if found:
-				if index:
-					return i
-				else:
-					return user
+		if isinstance(id, int):
+			user = self.users.get(id)
+		elif isinstance(id, str):
+			user = self.users.find("nickname", id)
+		else:
+			return
+		if user is not None and index:
+			return user["userid"]
+		return user
+
+	def get_user_by_username(self, username):
+		"""Retrieves attributes for a user logged in with the requested username.
+		Returns None if nobody is, and any one of them if the account allows multiple logins"""
+		return self.users.find("username", username)
 
 	def get_file(self, id, channel=None, index=False):
 		"""Retrieves attributes for files with the requested id.
 		If channel is given, limit the search to only files in the specified channel, can be anything accepted by get_channel
-		If index is False, returns a dict. Otherwise, returns the file's index in self.files
+		If index is False, returns a dict. Otherwise, returns the file's key in self.files (its fileid)
 		If id is of type str, look for matching filenames
 			Be careful, though, as teamtalk imposes no limit on files with the same name in different channels.
 		If id is an int, look for matching fileids
 		If id is a dict, we assume params are lazily being passed and try searching for a fileid"""
 		if isinstance(id, dict):
 			id = id.get("fileid")
-			if not id:
+		chanid = None
+		if channel is not None:
+			channel = self.get_channel(channel)
+			if channel is None:
 				return
-		channel = self.get_channel(channel)
-		channel = channel.get("chanid")
-		found = False
-		for i, file in enumerate(self.files):
-			if isinstance(id, int) and file["fileid"] == id:
-				if channel and file["chanid"] == channel:
-					found = True
-			elif isinstance(id, str) and file["filename"] == id:
-				if channel and file["chanid"] == channel:
-					found = True
-			if found:
+			chanid = channel["chanid"]
+		if isinstance(id, int):
+			candidates = [self.files.get(id)]
+		elif isinstance(id, str):
+			candidates = self.files.find_all("filename", id)
+		else:
+			return
+		for file in candidates:
+			if file is not None and (chanid is None or file.get("chanid") == chanid):
 				if index:
-					return i
-				else:
-					return file
+					return file["fileid"]
+				return file
 
 	def get_users_in_channel(self, id=None):
 		"""Retrieves a list of users in the specified channel.
 		id can be anything accepted by get_channel
 		There is one exception, however. If None, looks for users that aren't said to be in any channel"""
-		users = []
 		if id:
 			channel = self.get_channel(id)
-			id = channel.get("chanid")
-		for user in self.users:
-			if user.get("chanid") == id:
-				users.append(user)
-		return users
+			if channel is None:
+				return []
+			id = channel["chanid"]
+		return self.users.find_all("chanid", id)
 
 	def get_role(self, user=None):
 		"""Returns an str representing the provided user's role.
@@ -562,6 +1298,73 @@ class TeamTalkServer:
 			return "none"
 
 	# helpers for common actions
+	# every helper takes an id argument:
+	#	None sends the command and forgets about it
+	#	an int is sent along as the command's id, the response can then be tracked through the "begin" and "end" events
+	#	True sends the command through send_command and returns a future for its response
+
+	def _command(self, command, params, id=None, priority=PRIORITY_CONTROL, destination=None):
+		"""Sends a command for one of the helpers, see above for the meaning of id"""
+		if id is True:
+			return self.send_command(command, params, priority, destination)
+		if id:
+			params["id"] = id
+		return self.send(build_tt_message(command, params), priority, destination)
+
+	def send_command(self, command, params=None, priority=PRIORITY_CONTROL, destination=None):
+		"""Sends command with an automatically assigned id and returns a future for the server's response.
+		The future resolves with a list of (event, params) tuples for everything the server sent between "begin id=*" and "end id=*",
+		or raises TeamTalkError if one of them was an error.
+		Any number of commands can be in flight at once.
+		For TeamTalkServer this is a concurrent.futures.Future, AsyncTeamTalkServer returns an asyncio future that can be awaited"""
+		params = dict(params or {})
+		future = self._create_future()
+		with self._commands_lock:
+			id = self._next_id()
+			self._commands[id] = (future, [])
+		params["id"] = id
+		self._send_command_line(id, build_tt_message(command, params), priority, destination)
+		return future
+
+	def _next_id(self):
+		"""Returns an unused command id. 1 is reserved for login"""
+		for _ in range(MAX_COMMAND_ID):
+			self.last_id = self.last_id % MAX_COMMAND_ID + 1
+			if self.last_id != 1 and self.last_id not in self._commands:
+				return self.last_id
+		raise RuntimeError("Too many commands are waiting for a response")
+
+	def _create_future(self):
+		return concurrent.futures.Future()
+
+	def _send_command_line(self, id, line, priority, destination):
+		if not self.send(line, priority, destination):
+			self._finish_command(id, ConnectionError("Failed to send the command"))
+
+	def _finish_command(self, id, error=None):
+		"""Resolves the future for the command with the given id"""
+		with self._commands_lock:
+			command = self._commands.pop(id, None)
+		if command is None:
+			return
+		future, responses = command
+		if future.done():
+			# cancelled by whoever was waiting for it
+			return
+		if error is None:
+			for event, params in responses:
+				if event == "error" and params.get("number") not in (CMD_ERR_SUCCESS, CMD_ERR_IGNORE):
+					error = TeamTalkError(params.get("number"), params.get("message", ""))
+					break
+		if error is None:
+			future.set_result(responses)
+		else:
+			future.set_exception(error)
+
+	def _fail_commands(self):
+		"""Fails every command still waiting for a response, called on disconnect"""
+		for id in list(self._commands):
+			self._finish_command(id, ConnectionError("Disconnected before the server responded"))
 
 	def join(self, channel, password="", id=None):
 		"""Joins the specified channel, optionally with a password.
@@ -570,19 +1373,13 @@ class TeamTalkServer:
 		channel = self.get_channel(channel)
 		chanid = channel["chanid"]
 		params = {"chanid": chanid, "password": password}
-		if id:
-			params["id"] = id
-		msg = build_tt_message("join", params)
-		self.send(msg)
+		return self._command("join", params, id)
 
 	def leave(self, id=None):
 		"""Leaves the current channel.
 		An "error" event is thrown on failure, "left" on success"""
 		params = {}
-		if id:
-			params["id"] = id
-		msg = build_tt_message("leave", params)
-		self.send(msg)
+		return self._command("leave", params, id)
 
 	def kick(self, target, channel=None, id=None):
 		"""Kicks the provided user from a channel (if specified) otherwise the server.
@@ -595,10 +1392,7 @@ class TeamTalkServer:
 			channel = self.get_channel(channel)
 			channel = channel.get("chanid")
 			params["chanid"] = channel
-		if id:
-			params["id"] = id
-		msg = build_tt_message("kick", params)
-		self.send(msg)
+		return self._command("kick", params, id)
 
 	def move(self, user, destination, id=None):
 		"""Moves the provided user to destination.
@@ -609,10 +1403,7 @@ class TeamTalkServer:
 		channel = self.get_channel(destination)
 		channel = channel.get("chanid")
 		params = {"userid": user, "chanid": channel}
-		if id:
-			params["id"] = id
-		msg = build_tt_message("moveuser", params)
-		self.send(msg)
+		return self._command("moveuser", params, id)
 
 	def change_status(self, statusmode, statusmsg, id=None):
 		"""
@@ -623,18 +1414,12 @@ class TeamTalkServer:
 		2 Question
 		"""
 		params = {"statusmode": statusmode, "statusmsg" : statusmsg}
-		if id:
-			params["id"] = id
-		msg = build_tt_message("changestatus", params)
-		self.send(msg)
+		return self._command("changestatus", params, id)
 
 	def change_nickname(self, nickname, id=None):
 		"""Changes the nickname for the current user."""
 		params = {"nickname": nickname}
-		if id:
-			params["id"] = id
-		msg = build_tt_message("changenick", params)
-		self.send(msg)
+		return self._command("changenick", params, id)
 
 	def user_message(self, to, content, id=None):
 		"""Sends a private message to a user on this server.
@@ -643,10 +1428,7 @@ class TeamTalkServer:
 		to = self.get_user(to)
 		to = to.get("userid")
 		params = {"type": USER_MSG, "content": content, "destuserid": to}
-		if id:
-			params["id"] = id
-		msg = build_tt_message("message", params)
-		self.send(msg)
+		return self._command("message", params, id, PRIORITY_CHAT, ("user", to))
 
 	def channel_message(self, content, to=None, id=None):
 		"""Sends a channel message.
@@ -660,19 +1442,13 @@ class TeamTalkServer:
 		else:
 			to = self.me.get("chanid")
 		params = {"type": CHANNEL_MSG, "content": content, "chanid": to}
-		if id:
-			params["id"] = id
-		msg = build_tt_message("message", params)
-		self.send(msg)
+		return self._command("message", params, id, PRIORITY_CHAT, ("channel", to))
 
 	def broadcast_message(self, content, id=None):
 		"""Sends a broadcast (serverwide) message.
 		Content is the text that will be sent"""
 		params = {"type": BROADCAST_MSG, "content": content}
-		if id:
-			params["id"] = id
-		msg = build_tt_message("message", params)
-		self.send(msg)
+		return self._command("message", params, id, PRIORITY_CHAT, "broadcast")
 
 	def remove_channel(self, channel, id=None):
 		"""Removes a channel from the server, only available to admins.
@@ -680,10 +1456,7 @@ class TeamTalkServer:
 		channel = self.get_channel(channel)
 		chanid = channel.get("chanid")
 		params = {"chanid": chanid}
-		if id:
-			params["id"] = id
-		msg = build_tt_message("removechannel", params)
-		self.send(msg)
+		return self._command("removechannel", params, id)
 
 	def channel_operator(self, user=None, channel=None, password="", op=True, id=None):
 		"""Grants operator privileges on the provided channel.
@@ -703,36 +1476,29 @@ class TeamTalkServer:
 		else:
 			user = self.me.get("userid")
 		params = {"chanid": channel, "userid": user, "opstatus": op}
-		if id:
-			params["id"] = id
-		msg = build_tt_message("op", params)
-		self.send(msg)
+		return self._command("op", params, id)
 
-	def subscribe_to(self, user, subscription, id=None):
+	def subscribe_to(self, user, subscription, id=None, priority=PRIORITY_CONTROL):
 		"""Subscribe to an event on this server for a given user.
 			Not to be confused with subscribe, which maps events to local functions.
 		user can be anything accepted by get_user
-		subscription can be any teamtalk.SUBSCRIBE_* constant, or a bitmask for multiple"""
+		subscription can be any teamtalk.SUBSCRIBE_* constant, or a bitmask for multiple
+		Pass PRIORITY_BULK as priority when subscribing to many users at once, so the commands are paced"""
 		user = self.get_user(user)
 		user = user.get("userid")
 		params = {"userid": user, "sublocal": subscription}
-		if id:
-			params["id"] = id
-		msg = build_tt_message("subscribe", params)
-		self.send(msg)
+		return self._command("subscribe", params, id, priority)
 
-	def unsubscribe_from(self, user, subscription, id=None):
+	def unsubscribe_from(self, user, subscription, id=None, priority=PRIORITY_CONTROL):
 		"""Unsubscribes from an event on this server for a given user.
 			Not to be confused with subscribe, which maps events to local functions.
 		user can be anything accepted by get_user
-		subscription can be any teamtalk.SUBSCRIBE_* constant, or a bitmask for multiple"""
+		subscription can be any teamtalk.SUBSCRIBE_* constant, or a bitmask for multiple
+		Pass PRIORITY_BULK as priority when unsubscribing from many users at once, so the commands are paced"""
 		user = self.get_user(user)
 		user = user.get("userid")
 		params = {"userid": user, "sublocal": subscription}
-		if id:
-			params["id"] = id
-		msg = build_tt_message("unsubscribe", params)
-		self.send(msg)
+		return self._command("unsubscribe", params, id, priority)
 
 
 	# Internal event responses
@@ -746,6 +1512,8 @@ class TeamTalkServer:
 		"""Event fired when something goes wrong.
 		params["number"] contains the code, and params["message"] is a human-friendly explanation of what went wrong"""
 		print(f"error ({params['number']}): {params['message']}")
+		if params["number"] == CMD_ERR_COMMAND_FLOOD and self.scheduler is not None:
+			self._backoff()
 
 	@staticmethod
 	def _handle_begin(self, params):
@@ -772,6 +1540,7 @@ class TeamTalkServer:
 		Messages are sent this way when ordering needs to be preserved.
 		"""
 		self.current_id = 0
+		self._finish_command(params["id"])
 		# Logging in sends a flood of "loggedin" and "addchannel" packets
 		# Make it so these events can be handled differently if necessary
 		if params["id"] == 1:
@@ -782,24 +1551,19 @@ class TeamTalkServer:
 	def _handle_loggedin(self, params):
 		"""Event fired when a user has just logged in.
 		Is also sent during login for every currently logged in user"""
-		user_index = self.get_user(params["userid"], index=True)
-		if not user_index:
-			self.users.append(params)
-		else:
-			# something was updated
-			# I don't think this should happen, but just to be sure
-			self.users[user_index].update(params)
+		# if the user is already known something was updated
+		# I don't think this should happen, but just to be sure
+		self.users.add(params)
 
 	@staticmethod
 	def _handle_loggedout(self, params):
 		"""Event fired when a user logs out"""
 		if not params.get("userid") or params["userid"] == self.me["userid"]:
 			self.logged_out = True
-			self.disconnect()
+			# returned so that asynchronous transports can schedule it
+			return self.disconnect()
 		else:
-			user = self.get_user(params["userid"])
-			if user:
-				self.users.remove(user)
+			self.users.remove(params["userid"])
 
 	@staticmethod
 	def _handle_accepted(self, params):
@@ -812,32 +1576,27 @@ class TeamTalkServer:
 	def _handle_serverupdate(self, params):
 		"""Event fired after login that exposes more info to a client
 		May also mean that attributes of this server have changed"""
+		usertimeout = self.server_params.get("usertimeout")
 		self.server_params.update(params)
+		if self.server_params.get("usertimeout") != usertimeout:
+			self._wake_pinger()
 
 	@staticmethod
 	def _handle_addchannel(self, params):
 		"""Event fired when a new channel has been created
 		Can also be used to tell a newly connected user about a channel"""
-		chan_index = self.get_channel(params["chanid"], index=True)
-		if not chan_index:
-			self.channels.append(params)
-		else:
-			# shouldn't happen
-			self.channels[chan_index].update(params)
+		# merged into the known channel if it already exists, which shouldn't happen
+		self.channels.add(params)
 
 	@staticmethod
 	def _handle_updatechannel(self, params):
 		"""Event fired when an attribute of a channel has changed"""
-		chan_index = self.get_channel(params["chanid"], index=True)
-		if chan_index:
-			self.channels[chan_index].update(params)
+		self.channels.update(params["chanid"], params)
 
 	@staticmethod
 	def _handle_removechannel(self, params):
 		"""Event fired when a channel is deleted"""
-		channel = self.get_channel(params["chanid"])
-		if channel:
-			self.channels.remove(channel)
+		self.channels.remove(params["chanid"])
 
 	@staticmethod
 	def _handle_joined(self, params):
@@ -853,36 +1612,237 @@ class TeamTalkServer:
 	def _handle_adduser(self, params):
 		"""Event fired when a user is added (manually joins or is moved) to a channel.
 		Can also be used to tell a newly connected user about the location of other users on the server"""
-		user_index = self.get_user(params["userid"], index=True)
-		if user_index != None:
-			self.users[user_index].update(params)
+		self.users.update(params["userid"], params)
 
 	@staticmethod
 	def _handle_removeuser(self, params):
 		"""Event fired when a user is removed from (or leaves) a channel"""
-		user_index = self.get_user(params["userid"], index=True)
-		if user_index != None:
-			try:
-				del self.users[user_index]["chanid"]
-			except KeyError:
-				pass
+		self.users.pop_field(params["userid"], "chanid")
 
 	@staticmethod
 	def _handle_updateuser(self, params):
 		"""Event fired when an attribute of a user has changed"""
-		user_index = self.get_user(params["userid"], index=True)
-		if user_index != None:
-			self.users[user_index].update(params)
+		self.users.update(params["userid"], params)
 
 	@staticmethod
 	def _handle_addfile(self, params):
 		"""Event fired after a user joins a channel where files are available.
 		Sent for every downloadable file."""
-		self.files.append(params)
+		self.files.add(params)
 
 	@staticmethod
 	def _handle_removefile(self, params):
 		"""Event fired when a file is removed from a channel."""
-		file_index = self.get_file(params["filename"], params["chanid"], index=True)
-		if file_index != None:
-			del self.files[file_index]
+		fileid = self.get_file(params["filename"], params["chanid"], index=True)
+		if fileid is not None:
+			self.files.remove(fileid)
+
+
+class AsyncTeamTalkServer(TeamTalkServer):
+	"""Represents a single TeamTalk server, driven by an asyncio event loop.
+	Keeps track of the server's state exactly like TeamTalkServer, but talks to it over asyncio streams instead of telnetlib.
+	connect, login, handle_messages, handle_pings, send and disconnect are coroutines.
+	Every helper (join, user_message, channel_message, etc.) returns the coroutine from send, so await them as well.
+	Subscribed functions may be coroutine functions, in which case they are scheduled as tasks on the running loop
+	so that a slow handler never stops the socket from being read.
+	"""
+
+	# largest line we are willing to buffer, long messages and server properties easily exceed the asyncio default of 64 KiB
+	line_limit = 2 ** 20
+	# most bytes joined into a single write
+	batch_bytes = 16 * 1024
+
+	def __init__(self, host=None, tcpport=10333):
+		super().__init__(host, tcpport)
+		self.reader = None
+		self.writer = None
+		self.pinger_task = None
+		self.writer_task = None
+		self._queue_condition = None
+		self._pinger_wakeup = asyncio.Event()
+		self.last_write = 0.0
+		self._tasks = set()
+
+	async def connect(self):
+		"""Initiates the connection to this server
+		Raises an exception on failure"""
+		self.reader, self.writer = await asyncio.open_connection(self.host, self.tcpport, limit=self.line_limit)
+		self.scheduler = self._create_scheduler()
+		self._queue_condition = asyncio.Condition()
+		self.writer_task = self._create_task(self._write_loop())
+		self.last_received = time.monotonic()
+		# the first thing we should get is a welcome message
+		welcome = await self.read_line(timeout=3)
+		self._handle_welcome(welcome)
+
+	def reset(self):
+		"""Forgets the connection and everything learned through it, so that connect and login can be awaited again after disconnect.
+		Subscriptions, middleware, metrics and state tracking are kept"""
+		self.reader = None
+		self.writer = None
+		self.pinger_task = None
+		self.writer_task = None
+		self._reset_state()
+
+	async def login(self, nickname, username, password, client, protocol="5.6", version="1.0", callback=None):
+		"""Attempts to log in to the server.
+		This should be awaited immediately after connect to prevent timing out.
+		Returns once the login sequence has completed.
+		If callback is specified, it behaves the same as handle_messages for the duration of this sequence.
+		To intersept failed logins, provide a callback and check for the "error" event.
+		"""
+		message = self._build_login(nickname, username, password, client, protocol, version)
+		await self.send(message)
+		self.start_threads()
+		self._login_sequence = 1
+		await self.handle_messages(callback=callback)
+
+	def start_threads(self):
+		"""Starts the pinger as a task on the running loop, no threads are involved"""
+		self.pinger_task = self._create_task(self.handle_pings())
+
+	async def read_line(self, timeout=None):
+		"""Reads and returns a line from the server
+		Returns an empty line on timeout"""
+		if self.disconnecting:
+			return False
+		try:
+			return await asyncio.wait_for(self.reader.readuntil(b"\r\n"), timeout)
+		except asyncio.TimeoutError:
+			return b""
+		except asyncio.IncompleteReadError as e:
+			# the server closed the connection
+			self._connection_lost()
+			return e.partial
+		except (ConnectionError, OSError):
+			self._connection_lost()
+			return False
+
+	async def send(self, line, priority=PRIORITY_CONTROL, destination=None):
+		"""Queues a line to be sent to the server.
+		priority is PRIORITY_CONTROL, PRIORITY_CHAT or PRIORITY_BULK, chat lines are paced per destination (any hashable naming the recipient)
+		Waits while send_queue_bytes are already queued, returns False if the line could not be queued within send_timeout seconds"""
+		if self.disconnecting or not self.writer:
+			return False
+		line = self._encode_line(line)
+		condition = self._queue_condition
+		scheduler = self.scheduler
+		async with condition:
+			try:
+				await asyncio.wait_for(condition.wait_for(lambda: self.disconnecting or not scheduler.pending_lines or scheduler.pending_bytes + len(line) <= self.send_queue_bytes), self.send_timeout)
+			except asyncio.TimeoutError:
+				return False
+			if self.disconnecting:
+				return False
+			scheduler.push(line, priority, destination)
+			condition.notify_all()
+		return True
+
+	async def _write_loop(self):
+		"""Writes queued lines as soon as the scheduler allows, coalescing the ones that are ready at the same time"""
+		condition = self._queue_condition
+		while True:
+			async with condition:
+				lines, wait = self.scheduler.pop(time.monotonic(), self.batch_bytes)
+				if not lines:
+					if self.disconnecting and not self.scheduler.pending_lines:
+						return
+					try:
+						await asyncio.wait_for(condition.wait(), wait)
+					except asyncio.TimeoutError:
+						pass
+					continue
+				# room was freed for waiting senders
+				condition.notify_all()
+			# write only appends to the transport buffer and never yields, so batches can not interleave
+			self.writer.write(b"".join(lines))
+			self.last_write = time.monotonic()
+			try:
+				await self.writer.drain()
+			except ConnectionError:
+				self._connection_lost()
+				return
+
+	def _last_sent(self):
+		return self.last_write
+
+	def _backoff(self):
+		"""Slows chat messages and bulk commands down after a command flood error"""
+		self.scheduler.backoff()
+
+	def _create_future(self):
+		return asyncio.get_running_loop().create_future()
+
+	def _send_command_line(self, id, line, priority, destination):
+		async def send():
+			if not await self.send(line, priority, destination):
+				self._finish_command(id, ConnectionError("Failed to send the command"))
+		self._create_task(send())
+
+	async def disconnect(self):
+		"""Disconnect from this server.
+		Lines queued before the call are written first (for up to flush_timeout seconds)
+		Signals all tasks to stop"""
+		self.disconnecting = True
+		if self.pinger_task and self.pinger_task is not asyncio.current_task():
+			self.pinger_task.cancel()
+		if self.writer_task and self.writer_task is not asyncio.current_task():
+			async with self._queue_condition:
+				self._queue_condition.notify_all()
+			try:
+				await asyncio.wait_for(self.writer_task, self.flush_timeout)
+			except (asyncio.TimeoutError, asyncio.CancelledError):
+				pass
+		if self.writer:
+			self.writer.close()
+			try:
+				await self.writer.wait_closed()
+			except (ConnectionError, OSError):
+				pass
+		self._fail_commands()
+
+	async def handle_messages(self, timeout=1, callback=None):
+		"""Processes all incoming messages
+		Behaves like TeamTalkServer.handle_messages, but yields to the event loop while waiting for the next line.
+		"""
+		while not self.disconnecting:
+			if self._login_sequence == 2:
+				self._login_sequence = 0
+				break
+			line = await self.read_line(timeout)
+			if line is False:
+				continue
+			if not line and self._receive_timed_out():
+				self._connection_lost()
+				break
+			self._process_line(line, callback)
+
+	async def handle_pings(self):
+		"""Handles pinging the server at a reasonable interval.
+		Intervals are calculated based on the server's usertimeout value.
+		Pings are skipped while other traffic is being sent.
+		This coroutine always runs as its own task and is cancelled on disconnect."""
+		while not self.disconnecting:
+			delay = self._ping_delay()
+			if delay <= 0:
+				await self.send("ping")
+				delay = self._ping_interval()
+			try:
+				await asyncio.wait_for(self._pinger_wakeup.wait(), delay)
+			except asyncio.TimeoutError:
+				pass
+			self._pinger_wakeup.clear()
+
+	def _call_subscriber(self, func, params):
+		"""Runs a single subscribed function for an event
+		Anything awaitable it returns is scheduled on the running loop"""
+		result = func(self, params)
+		if inspect.isawaitable(result):
+			self._create_task(result)
+
+	def _create_task(self, coro):
+		"""Schedules coro on the running loop, keeping a reference so it isn't garbage collected while pending"""
+		task = asyncio.get_running_loop().create_task(coro)
+		self._tasks.add(task)
+		task.add_done_callback(self._tasks.discard)
+		return task
@@ -0,0 +1,5 @@
+# The modules of the bot live at the top of the repository, next to this folder.
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
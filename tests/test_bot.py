@@ -0,0 +1,152 @@
+import sys
+import json
+import time
+import asyncio
+import threading
+from pathlib import Path
+
+import pytest
+
+import teamtalk
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "benchmarks"))
+from mock_teamtalk import MockTeamTalkServer
+
+
+def wait_until(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.02)
+
+
+@pytest.fixture(scope="module")
+def loop():
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    yield loop
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+
+
+@pytest.fixture(scope="module")
+def bot_module(tmp_path_factory):
+    # bot.py creates its bot on import, from the settings in the home folder, and only skips the settings menu when run with "run".
+    home = tmp_path_factory.mktemp("home")
+    settings = dict(openai_api_key="", groq_api_key="", host="127.0.0.1", port=10333, username="bot", password="", nickname="bot",
+        channel="/", channel_password="", store_path="", stream_responses=False, reconnect_delay=0.05, reconnect_max_delay=0.2)
+    (home / ".tt-ai-bot.json").write_text(json.dumps(settings))
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setenv("HOME", str(home))
+        patch.setattr(sys, "argv", ["bot.py", "run"])
+        import bot as bot_module
+        yield bot_module
+
+
+@pytest.fixture(scope="module")
+def bot(bot_module):
+    bot = bot_module.bot
+    bot.chatgpt_user_messages, bot.groq_user_messages = {}, {}
+    return bot
+
+
+@pytest.fixture
+def offline_bot(bot_module):
+    # A bot that was never connected, which records what it sends instead.
+    bot = bot_module.Bot()
+    bot.sent = []
+    bot.user_message = lambda user, content, id=None: bot.sent.append((user["userid"], content))
+    bot.channel_message = lambda content, to=None, id=None: bot.sent.append((to, content))
+    bot.connected = True
+    return bot
+
+
+def test_answers_are_held_across_failed_reconnects(bot, loop):
+    received = []
+    server = MockTeamTalkServer(users=1, on_message=lambda client, params: received.append((params["type"], params["content"])))
+    port = asyncio.run_coroutine_threadsafe(server.start(), loop).result()
+    bot.settings["port"] = port
+    answer = threading.Event()
+    questions = []
+    def ask_ai(provider, chat_id, message, max_tokens=200, on_text=None):
+        questions.append(chat_id)
+        answer.wait()
+        return f"answer to {message}"
+    bot.ask_ai = ask_ai
+    bot.start_bot()
+    wait_until(lambda: bot.connected and any(client.chanid for client in server.clients.values()))
+    client = next(iter(server.clients.values()))
+    for content, type in (("1", teamtalk.USER_MSG), ("private question", teamtalk.USER_MSG), ("/1", teamtalk.CHANNEL_MSG), ("/channel question", teamtalk.CHANNEL_MSG)):
+        loop.call_soon_threadsafe(server.deliver, 1000, content, client, type)
+    wait_until(lambda: len(questions) == 2)
+
+    # The server goes away while both questions are being answered, and the first attempts to connect again fail.
+    asyncio.run_coroutine_threadsafe(server.stop(), loop).result()
+    wait_until(lambda: not bot.connected)
+    failures = bot.connection_failures.value()
+    wait_until(lambda: bot.connection_failures.value() > failures)
+    answer.set()
+    wait_until(lambda: len(bot.outbox) == 2)
+    failures = bot.connection_failures.value()
+    wait_until(lambda: bot.connection_failures.value() > failures)
+    assert len(bot.outbox) == 2
+
+    asyncio.run_coroutine_threadsafe(server.start(port=port), loop).result()
+    wait_until(lambda: bot.connected and not bot.outbox)
+    wait_until(lambda: len(received) >= 4)
+    assert (teamtalk.USER_MSG, "answer to private question") in received
+    assert (teamtalk.CHANNEL_MSG, "answer to channel question") in received
+    bot.settings["reconnect_delay"] = 60
+    asyncio.run_coroutine_threadsafe(server.stop(), loop).result()
+
+
+def test_private_answers_go_to_the_current_userid_of_the_username(offline_bot):
+    offline_bot.users.add({"userid": 5, "username": "alice", "nickname": "alice"})
+    # the server restarted while the question was being answered, and gave the old userid to somebody else
+    offline_bot._reset_state()
+    offline_bot.users.add({"userid": 5, "username": "bob", "nickname": "bob"})
+    offline_bot.users.add({"userid": 9, "username": "alice", "nickname": "alice"})
+    offline_bot.send_response(teamtalk.USER_MSG, "alice", "answer")
+    assert offline_bot.sent == [(9, "answer")]
+    offline_bot.send_response(teamtalk.USER_MSG, "carol", "answer to somebody who left")
+    assert offline_bot.sent == [(9, "answer")]
+    assert not offline_bot.outbox
+
+
+def test_answers_are_held_once_the_connection_is_disconnecting(offline_bot):
+    # lost, but supervise hasn't called connection_closed yet
+    offline_bot.disconnecting = True
+    offline_bot.send_response(teamtalk.USER_MSG, "alice", "answer")
+    assert offline_bot.sent == []
+    assert [held[2:] for held in offline_bot.outbox] == [("alice", None, "answer")]
+
+
+def test_users_are_only_intercepted_with_an_admin_account(offline_bot):
+    subscribed = []
+    offline_bot.subscribe_to = lambda user, subscription, id=None, priority=None: subscribed.append(user)
+    offline_bot.settings = dict(offline_bot.settings, channels=["/other/"])
+    offline_bot.channels.add({"chanid": 1, "channel": "/"})
+    offline_bot.channels.add({"chanid": 2, "channel": "/other/"})
+    offline_bot.me = {"userid": 1, "username": "bot", "chanid": 1, "usertype": teamtalk.USERTYPE_DEFAULT}
+    offline_bot.users.add({"userid": 5, "username": "alice", "nickname": "alice", "chanid": 2})
+    offline_bot.on_user_moved(offline_bot, {"userid": 5, "chanid": 2})
+    assert subscribed == [] and not offline_bot.intercepted
+    offline_bot.me["usertype"] = teamtalk.USERTYPE_ADMIN
+    offline_bot.on_user_moved(offline_bot, {"userid": 5, "chanid": 2})
+    assert subscribed == [5] and offline_bot.intercepted == {5}
+
+
+def test_channel_chats_saved_under_a_chanid_move_to_the_channel_path(offline_bot, tmp_path):
+    from store import ConversationStore
+    offline_bot.store = ConversationStore(tmp_path / "chats.db")
+    offline_bot.store.set_choice("channel:1", "groq")
+    offline_bot.store.add_message("groq", "channel:1", "user", "question")
+    offline_bot.store.set_choice("channel:7", "chatgpt")
+    offline_bot.channels.add({"chanid": 1, "channel": "/"})
+    offline_bot.migrate_channel_chats()
+    assert offline_bot.store.get_choice("channel:/") == "groq"
+    assert offline_bot.store.load_messages("groq", "channel:/") == [("user", "question")]
+    assert offline_bot.store.get_choice("channel:1") is None
+    # nothing to tell which channel that was
+    assert offline_bot.store.get_choice("channel:7") == "chatgpt"
@@ -0,0 +1,81 @@
+import time
+import threading
+
+from providers import Provider, HedgedCompleter, register
+
+
+class StubResponse:
+    def __init__(self):
+        self.closed = threading.Event()
+
+    def close(self):
+        self.closed.set()
+
+
+class StubProvider(Provider):
+    # Answers after delay seconds, unless its response is closed first.
+    def __init__(self, name, delay):
+        super().__init__("key")
+        self.name = name
+        self.delay = delay
+        self.running = 0
+        self._lock = threading.Lock()
+
+    def complete(self, messages, model, max_tokens, on_text=None, abort=None):
+        response = StubResponse()
+        if abort:
+            abort.register(response)
+        with self._lock:
+            self.running += 1
+        try:
+            if response.closed.wait(self.delay):
+                raise ConnectionError("the response was closed")
+        finally:
+            with self._lock:
+                self.running -= 1
+        answer = f"answer of {self.name}"
+        if on_text:
+            on_text(answer)
+        return answer
+
+
+def hedged_pair(primary_delay, fallback_delay):
+    primary = register(StubProvider("stub-primary", primary_delay))
+    fallback = register(StubProvider("stub-fallback", fallback_delay))
+    for _ in range(25):
+        primary.latency.add(0.015)
+    return primary, fallback, HedgedCompleter({primary.name: fallback.name})
+
+
+def ask_all(completer, provider, count):
+    answers = []
+    threads = [threading.Thread(target=lambda: answers.append(completer.complete(provider, [], "", 10))) for _ in range(count)]
+    start = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return answers, time.monotonic() - start
+
+
+def test_hung_primaries_are_aborted_and_never_hold_up_the_fallback():
+    primary, fallback, completer = hedged_pair(5, 0.05)
+    for _ in range(2):
+        answers, seconds = ask_all(completer, primary, 8)
+        assert answers == ["answer of stub-fallback"] * 8
+        assert seconds < 1
+    deadline = time.monotonic() + 1
+    while primary.running and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert primary.running == 0
+    # aborted requests are not failures of the provider
+    assert primary.breaker.failures == 0
+
+
+def test_latency_of_aborted_requests_raises_the_p95():
+    primary, fallback, completer = hedged_pair(1, 0.05)
+    samples = len(primary.latency)
+    for _ in range(3):
+        assert completer.complete(primary, [], "", 10) == "answer of stub-fallback"
+    assert len(primary.latency) == samples + 3
+    assert primary.latency.percentile(95) > 0.05
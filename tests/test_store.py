@@ -0,0 +1,12 @@
+from store import ConversationStore, ChatHistories
+
+
+def test_pop_says_whether_there_was_a_history_in_memory_or_on_disk():
+    store = ConversationStore(":memory:")
+    histories = ChatHistories("groq", store)
+    store.add_message("groq", "only on disk", "user", "question")
+    histories.history("in memory").append("user", "question")
+    assert histories.pop("only on disk") is True
+    assert histories.pop("in memory") is True
+    assert histories.pop("only on disk") is False
+    assert "in memory" not in histories
@@ -0,0 +1,38 @@
+import teamtalk
+
+
+def connected_server():
+    # A server with the outbound queue of a connection, but nothing to write to.
+    server = teamtalk.TeamTalkServer()
+    server.scheduler = server._create_scheduler()
+    server.line_writer = teamtalk.LineWriter(lambda data: None, server.scheduler)
+    return server
+
+
+def test_flood_error_halves_the_rate_with_an_empty_queue():
+    server = connected_server()
+    rate = server.scheduler.global_bucket.rate
+    assert server.queue_depth() == 0
+    server._process_line(b'error number=2014 message="Command flooding prevented by server"')
+    assert server.scheduler.global_bucket.rate == rate / 2
+    assert server.scheduler.global_bucket.tokens == 0
+
+
+def test_bulk_lines_are_paced_by_the_global_rate_and_yield_to_chat():
+    scheduler = teamtalk.SendScheduler(rate=8, burst=10)
+    now = scheduler.global_bucket.updated
+    for number in range(50):
+        scheduler.push(f"subscribe userid={number}".encode(), teamtalk.PRIORITY_BULK)
+    scheduler.push(b"ping", teamtalk.PRIORITY_CONTROL)
+    scheduler.push(b"message", teamtalk.PRIORITY_CHAT, "user")
+    lines, wait = scheduler.pop(now, 1 << 20)
+    # the burst of the global bucket: the ping is free, the chat line goes before the bulk ones
+    assert lines[:2] == [b"ping", b"message"]
+    assert len(lines) == 11
+    assert wait == 1 / 8
+    lines, wait = scheduler.pop(now + 0.5, 1 << 20)
+    assert len(lines) == 4
+    # after a flood error only half as many
+    scheduler.backoff(now + 0.5)
+    lines, wait = scheduler.pop(now + 1, 1 << 20)
+    assert len(lines) == 2
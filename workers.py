@@ -0,0 +1,104 @@
+# A fixed size thread pool for answering AI questions.
+# Jobs are queued per chat: the jobs of one chat run one at a time and in the order they arrived,
+# while jobs of different chats run in parallel on the available workers.
+
+
+import threading
+import traceback
+from collections import deque
+
+
+class ChatWorkerPool:
+    def __init__(self, workers=8, max_pending=100, max_pending_per_chat=5):
+        self.workers = workers
+        # Jobs waiting for a worker, over all chats and for a single chat. Beyond these, submit refuses new jobs.
+        self.max_pending = max_pending
+        self.max_pending_per_chat = max_pending_per_chat
+        # chat_id -> jobs of that chat which haven't started yet. A chat stays here while one of its jobs is running.
+        self._queues = {}
+        # chats that have waiting jobs and no running job, in the order they should be served
+        self._ready = deque()
+        self._condition = threading.Condition()
+        self._threads = []
+        self._stopping = False
+        self.pending = 0
+        self.running = 0
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+
+    def start(self):
+        for number in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"ai-worker-{number}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, chat_id, func, *args):
+        # Queue func(*args) behind the other jobs of chat_id. Returns False if the pool is too busy to accept it.
+        with self._condition:
+            queue = self._queues.get(chat_id)
+            if self._stopping or self.pending >= self.max_pending or (queue and len(queue) >= self.max_pending_per_chat):
+                self.rejected += 1
+                return False
+            if queue is None:
+                queue = self._queues[chat_id] = deque()
+                self._ready.append(chat_id)
+            queue.append((func, args))
+            self.pending += 1
+            self.submitted += 1
+            self._condition.notify()
+        return True
+
+    def stats(self):
+        with self._condition:
+            return dict(
+                workers=self.workers,
+                running=self.running,
+                pending=self.pending,
+                chats=len(self._queues),
+                submitted=self.submitted,
+                completed=self.completed,
+                failed=self.failed,
+                rejected=self.rejected,
+            )
+
+    def stop(self, wait=True):
+        # Let the workers finish the jobs already queued, then end their threads.
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._ready or (self._stopping and not self.pending))
+                if not self._ready:
+                    return
+                chat_id = self._ready.popleft()
+                func, args = self._queues[chat_id].popleft()
+                self.pending -= 1
+                self.running += 1
+            failed = False
+            try:
+                func(*args)
+            except Exception:
+                failed = True
+                traceback.print_exc()
+            finally:
+                with self._condition:
+                    self.running -= 1
+                    self.completed += 1
+                    self.failed += failed
+                    # The next job of this chat may only start now, so the answers stay in order.
+                    if self._queues[chat_id]:
+                        self._ready.append(chat_id)
+                        self._condition.notify()
+                    else:
+                        del self._queues[chat_id]
+                    if self._stopping:
+                        # wake the idle workers, they may be able to exit now
+                        self._condition.notify_all()